@@ -33,6 +33,7 @@ Options:
 
   -e --extract-dir=<d>      Extract attachment to this directory. [Default: ./]
      --extract-only         Don't detach attachments, extract only.
+     --fetch-batch=<n>      Maximum number of messages fetched by a single IMAP command. [Default: 100]
      --flagged=<f>          Flagged/starred mail behaviour: [Default: skip]
                               - detach:     detach as a normal mail.
                               - extract:    extract only, leave message intact.
@@ -50,31 +51,78 @@ Options:
      --thunderbird          Implements thunderbird detach mode, pointing to the extracted file local URL.
   -v --verbose              Display more information.
 """
+import atexit
 import calendar
 import imaplib
+import io
+import queue
 import sys
-from binascii import Error as BinasciiError
+import threading
+from functools import lru_cache
+from binascii import Error as BinasciiError, a2b_base64, a2b_qp
 import os
 import re
+import socket
 from base64 import b64decode, b64encode
 import getpass
+from collections import deque, namedtuple
 from configparser import ConfigParser
 
-from datetime import date, datetime
-from email import message_from_bytes, policy
-from email.message import EmailMessage, Message
+from datetime import date
+from email import policy
+from email.message import Message
+from email.generator import BytesGenerator
 from email.header import decode_header
-from imaplib import IMAP4_SSL, IMAP4, Time2Internaldate, ParseFlags
+from email.parser import BytesHeaderParser, BytesParser
+from email.utils import decode_rfc2231
+from imaplib import IMAP4_SSL, IMAP4, Time2Internaldate
 from time import time
+from urllib.parse import unquote
 
-import keyring
 from docopt import docopt, parse_defaults
 
+DECODE_CHUNK_SIZE = 64 * 1024  # base64 decode buffer size
+BASE64_IGNORED = bytes(sorted(set(range(256)) - set(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=')))
+PIPELINE_DEPTH = 2  # FETCH commands in flight
+STRUCTURE_BATCH_SIZE = 200  # messages per BODYSTRUCTURE FETCH command
+STORE_BATCH_SIZE = 500  # messages per STORE command
+NOOP_INTERVAL = 5 * 60  # seconds of inactivity before checking the connection
+FETCH_CONNECTIONS = 3  # maximum parallel fetch connections
+FETCH_CONNECTION_MESSAGES = 50  # minimum messages to fetch per background connection
+FETCH_BATCH_BYTES = 16 * 1024 * 1024  # maximum estimated size of the messages fetched by a FETCH command
+BINARY_ENCODINGS = frozenset(("base64", "quoted-printable"))  # encodings decoded by servers with the BINARY capability
+ATTACHMENT_REGEX = re.compile(rb'"(?:attachment|application")', re.IGNORECASE)  # BODYSTRUCTURE tokens of attachment candidates
+ATTACHMENT_IMAGE_REGEX = re.compile(rb'"(?:attachment|application"|image")', re.IGNORECASE)
+
+DATE_DEF_REGEX = re.compile(r"^([<>])?\s*(\d{4})-?(\d{2})?-?(\d{2})?(\s*to\s*)?(\d{4})?-?(\d{2})?-?(\d{2})?")
+FILENAME_INDEX_REGEX = re.compile(r"^(\d{4}-\d{2}-\d{2}) (?:\((\d+)\) )?- (.*)$")
+IMAP_UTF7_ALTCHARS = b'+,'  # modified base64 alphabet, ',' replaces '/'
+IMAP_UTF7_DECODE_REGEX = re.compile(r"&([A-Za-z0-9+,]*)-")  # encoded run, or '&-' for '&'
+IMAP_UTF7_ENCODE_REGEX = re.compile(r"[^\x20-\x7e]+")  # run of non printable ASCII characters
+HEADER_PARSER = BytesHeaderParser(policy=policy.default)  # decodes the header values on access
+BodyPart = namedtuple('BodyPart', ('section', 'content_type', 'encoding', 'size', 'disposition', 'filename'))
+
+SIZE_UNITS = ('', 'K', 'M', 'G', 'T', 'P', 'E', 'Z')
+SIZE_UNIT_SHIFTS = {'': 0, 'K': 10, 'M': 20, 'G': 30, 'T': 40, 'P': 50, 'E': 60, 'Z': 70, 'Y': 80}
+SIZE_LABEL_REGEX = re.compile(r"^(\d[\d.]*)(K|M|G|T|P|E|Z|Y)?([A-Z]+)?$")
+
+
+class ImapConnection(IMAP4_SSL):
+    """IMAP4_SSL connection without Nagle's algorithm delaying the pipelined commands."""
+
+    def open(self, *args, **kwargs):
+        super().open(*args, **kwargs)
+        tune_socket(self.sock)
+
 
 class ImapAttachmentExtractor:
+    connection_pool = {}  # pooled connections by (host, port, login)
+    connection_pool_lock = threading.Lock()
+
     def __init__(self, host, login, port=993, folder='INBOX', extract_dir="./", no_subdir=False, dir_reg=None,
                  thunderbird_mode=False, max_size='100K', flagged_action="skip", extract_only=False,
-                 inline_images=False, dry_run=False, ask_password=False, debug=False, verbose=False):
+                 inline_images=False, dry_run=False, ask_password=False, debug=False, verbose=False,
+                 pool_connection=False, fetch_batch=100):
         """IMAP Attachment extractor.
 
         :param str host: IMAP host name.
@@ -95,6 +143,11 @@ class ImapAttachmentExtractor:
         :param bool ask_password: Prompt for password instead of looking in keyring. (default: False)
         :param bool debug: Debug mode, don't delete original message. (default: False)
         :param bool verbose: Display more information. (default: False)
+        :param bool pool_connection: Keep the connection open on exit, to be reused by the next extractor on the same
+                                     host and login in this process. Library use only, the command line runs a single
+                                     extractor. The pooled connections are logged out by close_connection_pool, or at
+                                     exit. (default: False)
+        :param int fetch_batch: Maximum number of messages fetched by a single FETCH command. (default: 100)
         """
 
         # server init
@@ -102,13 +155,15 @@ class ImapAttachmentExtractor:
         self.host = host
         self.port = port
         self.login = login
+        self.owns_connection = not pool_connection
+        self.last_activity = 0
 
         # check basic configuration
         if not self.host or not self.login:
             raise RuntimeWarning("Missing host and login configuration.")
 
         # max size
-        if type(max_size) == int:
+        if isinstance(max_size, int):
             self.max_size = max_size
         else:
             self.max_size = human_readable_size_to_bytes(max_size)
@@ -118,22 +173,20 @@ class ImapAttachmentExtractor:
         self.thunderbird_mode = thunderbird_mode
         self.extract_dir = os.path.abspath(extract_dir)
         self.no_subdir = no_subdir
-        self.dir_reg = []
+        self.dir_reg = ()  # (compiled pattern, replacement) tuples, hashable for the folder_subdir cache
         if dir_reg is not None:
-            for reg in dir_reg.split('::'):
-                self.dir_reg.append(tuple(reg.split('>>')))
+            self.dir_reg = tuple((re.compile(reg[0]), reg[1] if len(reg) > 1 else '')
+                                 for reg in (reg.split('>>') for reg in dir_reg.split('::')))
 
-        subdir_path = self.folder
-        if not self.no_subdir and subdir_path:
-            if self.dir_reg:
-                for dr in self.dir_reg:
-                    m = dr[0]
-                    s = dr[1] if len(dr) > 1 else ''
-                    subdir_path = re.sub(m, s, subdir_path)
+        if not self.no_subdir and self.folder:
+            self.extract_dir = os.path.join(self.extract_dir, *folder_subdir(self.folder, self.dir_reg).split('/'))
 
-            self.extract_dir = os.path.join(self.extract_dir, *subdir_path.split('/'))
+        self.filename_index = None  # next extract filename index by (date, attachment filename)
+        self.deleted_uids = []  # detached messages to delete
+        self.binary_refused = False  # server unable to decode some parts with BINARY, decode them client side
 
         self.inline_images = inline_images
+        self.fetch_batch = max(1, fetch_batch)
         self.dry_run = dry_run
         self.flagged_action = flagged_action
         self.extract_only = extract_only
@@ -151,6 +204,8 @@ class ImapAttachmentExtractor:
 
     def list(self):
         """List IMAP folders"""
+        self.ensure_connected()
+
         status, list_data = self.imap.list()
         if status != "OK":
             raise RuntimeWarning("Could not list folders")
@@ -160,7 +215,7 @@ class ImapAttachmentExtractor:
         for folder in list_data:
             folder = folder.split(b' "/" ')[1].decode()
             folder = imaputf7decode(folder)
-            folder = re.sub('(^"|"$)', '', folder)
+            folder = folder.strip('"')
             max_len = max(max_len, len(folder))
             folders.append(folder)
 
@@ -169,21 +224,15 @@ class ImapAttachmentExtractor:
         print('  '.ljust(max_len+4, '-'), ''.ljust(30, '-'))
         for folder in folders:
             extract_dir = self.extract_dir
-            subdir_path = folder
-            if not self.no_subdir and subdir_path:
-                if self.dir_reg:
-                    for dr in self.dir_reg:
-                        m = dr[0]
-                        s = dr[1] if len(dr) > 1 else ''
-                        subdir_path = re.sub(m, s, subdir_path)
-
-                extract_dir = os.path.join(*subdir_path.split('/'))
+            if not self.no_subdir and folder:
+                extract_dir = os.path.join(*folder_subdir(folder, self.dir_reg).split('/'))
 
             print('  '+folder.ljust(max_len+2), extract_dir)
 
         print()
 
     @staticmethod
+    @lru_cache(maxsize=64)
     def parse_date(date_def, date_format="imap"):
         """Parse and format a date definition.
 
@@ -205,7 +254,7 @@ class ImapAttachmentExtractor:
         elif date_format == "ymd":
             date_format = "%Y-%m-%d"
 
-        match = re.match("^([<>])?\s*(\d{4})-?(\d{2})?-?(\d{2})?(\s*to\s*)?(\d{4})?-?(\d{2})?-?(\d{2})?", date_def)
+        match = DATE_DEF_REGEX.match(date_def)
         if not match:
             raise RuntimeWarning("Invalid date definition: %s." % date_def)
 
@@ -255,19 +304,19 @@ class ImapAttachmentExtractor:
                     date_before = date(y2, 12, 31)
                 elif d2 is None:
                     m2 = int(m2)
-                    date_before = date(y2, m2, calendar.monthrange(y2, m2)[2])
+                    date_before = date(y2, m2, calendar.monthrange(y2, m2)[1])
                 else:
                     m2 = int(m2)
                     d2 = int(d2)
                     date_before = date(y2, m2, d2)
 
-        if type(date_since) == date:
+        if isinstance(date_since, date):
             ret_date_since = date_since.strftime(date_format)
 
-        if type(date_before) == date:
+        if isinstance(date_before, date):
             ret_date_before = date_before.strftime(date_format)
 
-        if type(date_on) == date:
+        if isinstance(date_on, date):
             ret_date_on = date_on.strftime(date_format)
 
         return ret_date_on, ret_date_since, ret_date_before
@@ -287,6 +336,9 @@ class ImapAttachmentExtractor:
         else:
             print("[Dry-run] Create extract dir %s." % self.extract_dir)
 
+        self.filename_index = None
+        self.ensure_connected()
+
         folder = self.folder
         if " " in self.folder:
             folder = '"%s"' % folder
@@ -306,21 +358,25 @@ class ImapAttachmentExtractor:
 
             date_crit = []
             if date_on:
-                date_crit.append('ON "%s"' % date_on)
+                date_crit.append('ON %s' % date_on)
 
             if date_since:
-                date_crit.append('SINCE "%s"' % date_since)
+                date_crit.append('SINCE %s' % date_since)
 
             if date_before:
-                date_crit.append('BEFORE "%s"' % date_before)
+                date_crit.append('BEFORE %s' % date_before)
         else:
+            dates = None
             date_crit = []
 
-        # status, search_data = self.imap.search("UTF-8", 'UNDELETED', 'ON "27-aug-2018"')
+        # an attachment can't be bigger than its message, skip smaller messages without fetching their structure
+        size_crit = ['LARGER %d' % (self.max_size - 1)] if self.max_size > 0 else []
+
+        # status, search_data = self.imap.uid('SEARCH', 'CHARSET', 'UTF-8', 'UNDELETED', 'ON 27-Aug-2018')
         if not self.gmail_mode:
-            status, search_data = self.imap.search("UTF-8", 'UNDELETED', *date_crit)
+            status, search_data = self.imap.uid('SEARCH', 'CHARSET', 'UTF-8', 'UNDELETED', *size_crit, *date_crit)
         else:
-            status, search_data = self.imap.search("UTF-8", 'UNDELETED', 'X-GM-RAW', 'has:attachment', *date_crit)
+            status, search_data = self.imap.uid('SEARCH', 'CHARSET', 'UTF-8', 'UNDELETED', 'X-GM-RAW', 'has:attachment', *size_crit, *date_crit)
         if status != "OK":
             raise RuntimeWarning("Could not search in %s" % folder)
 
@@ -332,339 +388,764 @@ class ImapAttachmentExtractor:
         print("%d messages corresponding to search." % len(uids))
 
         if not uids:
-            exit(0)
+            return
 
         to_fetch = []
 
-        try:
-            status, fetch_data = self.imap.fetch(b','.join(uids), 'BODYSTRUCTURE[PEEK]')
-        except IMAP4.error:
-            status, fetch_data = self.imap.fetch(b','.join(uids), 'BODYSTRUCTURE')
+        requests = []
+        for i in range(0, len(uids), STRUCTURE_BATCH_SIZE):
+            requests.append((b','.join(uids[i:i + STRUCTURE_BATCH_SIZE]), '(FLAGS BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (DATE SUBJECT)])'))
 
-        if status != "OK":
-            print("Could not fetch messages.")
+        prefilter = ATTACHMENT_IMAGE_REGEX if self.inline_images else ATTACHMENT_REGEX
+        responses = (response for request, batch in self.fetch_pipeline(requests, prefilter=prefilter) for response in batch)
+        for uid, items in responses:
+            structure = items.get(b'BODYSTRUCTURE')
+            if not isinstance(structure, list):
+                continue
+
+            try:
+                parts = [p for p in parse_bodystructure(structure) if self.is_extractable(p)]
+            except (IndexError, ValueError) as e:
+                print("Failed to process message. Error: %s" % e)
+                continue
 
-        merge_previous = False
-        previous_structure = b''
+            if not parts:
+                continue
 
-        for structure in fetch_data:  # type: bytes
-            if type(structure) in (list, tuple):
-                if len(structure) == 2:
-                    structure = structure[0] + b'"'+structure[1]+b'"'
-                else:
-                    structure = b' '.join(structure)
+            # the search is done on the internal date, check the message date before fetching the message
+            headers = next((value for key, value in items.items() if key.startswith(b'BODY[HEADER')), None)
+            subject, mail_date = self.mail_info(HEADER_PARSER.parsebytes(headers or b''))
 
-            if not structure.endswith(b')'):
-                previous_structure = b''+structure
-                merge_previous = True
+            if not self.date_in_range(mail_date, dates):
+                if self.verbose:
+                    print("Skip email: '%s' [%s] (possible previous extract)." % (subject, mail_date))
                 continue
 
-            if merge_previous:
-                structure = previous_structure + structure
-                merge_previous = False
+            flags = tuple(map(lambda x: x.decode("utf-8"), items.get(b'FLAGS') or ()))
+            to_fetch.append((uid, flags, parts, subject, mail_date))
 
-            reg_attachment = "attachment|application"
-            if self.inline_images:
-                reg_attachment = reg_attachment+"|image"
+        print("%d messages with attachments bigger than %s." % (len(to_fetch), human_readable_size(self.max_size)))
+        print()
 
-            try:
-                has_attachments = re.match('^.*"(%s)".*$' % reg_attachment, structure.decode("utf-8"), re.IGNORECASE) is not None
-            except AttributeError as e:
-                print("Failed to process message. Error: %s" % e)
-                has_attachments = False
-            if not has_attachments:
+        if not to_fetch:
+            return
+
+        # let the server decode the attachment parts if possible
+        use_binary = "BINARY" in self.imap.capabilities
+
+        groups = {}  # messages by fetched data items
+        for uid, flags, parts, subject, mail_date in sorted(to_fetch, key=lambda x: int(x[0])):
+            is_flagged = "\\Flagged" in flags
+            if is_flagged and 'skip' == self.flagged_action:
+                if self.verbose:
+                    print("\nSkip flagged mail %s." % uid.decode())
                 continue
-            uid = structure.split(b' ')[0]
 
-            if uid:
-                to_fetch.append(uid)
+            if self.extract_only or is_flagged and 'extract' == self.flagged_action:
+                # message left intact, only fetch the attachment parts
+                message_parts = "(%s)" % " ".join(
+                    ("BINARY.PEEK[%s]" if use_binary and part.encoding in BINARY_ENCODINGS else "BODY.PEEK[%s]") % part.section
+                    for part in parts)
+                groups.setdefault(message_parts, []).append((uid, flags, parts, subject, mail_date, False))
             else:
-                # Probably an eml attachment
-                pass
+                # whole message needed to append the detached message, peek not to set the \Seen flag
+                groups.setdefault('(FLAGS BODY.PEEK[])', []).append((uid, flags, parts, subject, mail_date, True))
+
+        # fetch the messages by batches, bounded in number and estimated size
+        requests = []
+        for message_parts, messages in groups.items():
+            batch = []
+            batch_size = 0
+            for message in messages:
+                size = sum(part.size for part in message[2])
+                if batch and (len(batch) >= self.fetch_batch or batch_size + size > FETCH_BATCH_BYTES):
+                    requests.append((b','.join(m[0] for m in batch), message_parts, batch))
+                    batch = []
+                    batch_size = 0
+
+                batch.append(message)
+                batch_size = batch_size + size
+
+            if batch:
+                requests.append((b','.join(m[0] for m in batch), message_parts, batch))
+
+        requests.sort(key=lambda x: int(x[2][0][0]))
+
+        try:
+            for (message_set, message_parts, messages), responses in self.fetch_parallel(requests, folder):
+                items_by_uid = {}
+                for response_uid, response_items in responses:
+                    items_by_uid.setdefault(response_uid, {}).update(response_items)
+
+                for uid, flags, parts, subject, mail_date, detach in messages:
+                    items = items_by_uid.get(uid, {})
+                    if detach:
+                        self.detach_attachments(uid, flags, items, subject, mail_date, folder)
+                    else:
+                        self.extract_parts(uid, flags, parts, items, subject, mail_date)
+        finally:
+            # also delete the messages already appended when the extraction is interrupted
+            self.delete_messages()
 
-        print("%d messages with attachments." % len(to_fetch))
         print()
+        print('Extract finished.')
 
-        if not to_fetch:
-            exit(0)
+        if self.extracted_size > 0:
+            if not self.dry_run:
+                print("  Extracted %d files from %s messages, %s gain." % (self.extracted_nb, self.extracted_from_nb, human_readable_size(self.extracted_size)))
+            else:
+                print("  [Dry-run] Extracted %d files from %s messages, %s gain." % (self.extracted_nb, self.extracted_from_nb, human_readable_size(self.extracted_size)))
+
+            if self.verbose:
+                print("  Thunderbird headers used: %s." % ("yes" if self.thunderbird_mode else "no"))
+
+        print()
+
+    def append_message(self, folder, flags, mail_date, message):
+        """Append a message to a folder, serializing it directly in the APPEND literal buffer.
+
+        Unlike IMAP4.append, the serialized message is neither copied to a str nor rewritten to fix its line endings,
+        as the generator policy already writes CRLF line endings.
+
+        :param str folder: The folder to append to.
+        :param tuple flags: The message flags.
+        :param datetime mail_date: The message date, or None.
+        :param Message message: The message.
+        :return: The APPEND command status and data.
+        :rtype: (str, list)
+        """
+        buffer = io.BytesIO()
+        BytesGenerator(buffer, mangle_from_=False, policy=policy.SMTPUTF8).flatten(message)
+
+        self.imap.literal = buffer.getbuffer()
+        return self.imap._simple_command('APPEND', imaputf7encode(folder), "(%s)" % " ".join(flags) if flags else None,
+                                         Time2Internaldate(mail_date.astimezone()) if mail_date else None)
+
+    def delete_messages(self):
+        """Flag the original messages of the appended detached messages as deleted, by batches."""
+        uids, self.deleted_uids = self.deleted_uids, []
+        for i in range(0, len(uids), STORE_BATCH_SIZE):
+            batch_uids = uids[i:i + STORE_BATCH_SIZE]
+            batch = b','.join(batch_uids)
+            try:
+                # silent store, the FLAGS responses are not needed
+                status, store_data = self.imap._simple_command('UID', 'STORE', batch, '+FLAGS.SILENT', '\\Deleted')
+            except IMAP4.error as e:
+                status, store_data = "NO", [repr(e)]
+
+            if status != "OK":
+                print("Could not delete original messages %s from IMAP server: %s" % (batch.decode(), store_data))
+            elif self.verbose:
+                print("Deleted %d original message%s." % (len(batch_uids), "s" if len(batch_uids) > 1 else ""))
+
+    def fetch_pipeline(self, requests, imap=None, prefilter=None, answered=None):
+        """Fetch messages, keeping the next FETCH command in flight while a response is processed.
 
-        for uid in to_fetch:
+        The caller must not send STORE or FETCH commands while iterating, as they would pop the pipelined responses.
+
+        :param list requests: Requests tuples, starting with the message set and the message data item names.
+        :param IMAP4 imap: The connection to use. (default: the extractor connection)
+        :param re.Pattern prefilter: Only parse the responses matching this bytes regex. (default: parse all)
+        :param list answered: Receives the requests answered by the server, fetched or failed.
+        :return: A generator of (request, responses) tuples, responses as returned by parse_fetch_data.
+        """
+        imap = imap or self.imap
+        if answered is None:
+            answered = []
+        requests = iter(requests)
+        pending = deque()
+        retries = deque()  # requests to send again
+
+        while True:
+            while len(pending) < PIPELINE_DEPTH:
+                request = retries.popleft() if retries else next(requests, None)
+                if request is None:
+                    break
+                sent = without_binary(request) if self.binary_refused else request
+                pending.append((request, imap._command('UID', 'FETCH', sent[0], sent[1])))
+
+            if not pending:
+                return
+
+            request, tag = pending.popleft()
             try:
-                status, fetch_data = self.imap.fetch(uid, '(FLAGS RFC822)')
+                status, fetch_data = imap._command_complete('UID', tag)
+                status, fetch_data = imap._untagged_response(status, fetch_data, 'FETCH')
+            except imaplib.IMAP4.abort:
+                raise  # connection lost, the pending requests will never be answered
             except imaplib.IMAP4.error as e:
-                print("Encountered error when reading mail uid %s: %s" % (uid, repr(e)))
+                answered.append(request)
+                print("Encountered error when reading mail uid %s: %s" % (request[0], repr(e)))
                 continue
 
             if status != "OK":
-                print("Could not fetch messages")
+                imap.untagged_responses.pop('FETCH', None)  # partial responses of the failed command
 
-            skip_flags = False
-            for i in range(len(fetch_data)):
-                if skip_flags:
-                    # previous mail flags part
-                    skip_flags = False
+                if 'BINARY.PEEK[' in request[1] and b'[UNKNOWN-CTE]' in b' '.join(d or b'' for d in fetch_data).upper():
+                    # the server can't decode a part (RFC 3516), fetch the parts undecoded for the rest of the run
+                    self.binary_refused = True
+                    retries.append(request)
                     continue
 
-                fetch = fetch_data[i]
-                if b')' == fetch:
-                    continue
+                answered.append(request)
+                print("Could not fetch messages %s." % request[0].decode())
+                continue
 
-                flags = ParseFlags(bytes(fetch[0]))
-                if not flags and i + 1 < len(fetch_data) and type(fetch_data[i+1]) == bytes:
-                    # check if flags are in the next fetch_data
-                    flags = ParseFlags(fetch_data[i+1])
-                    if flags:
-                        skip_flags = True
+            answered.append(request)
 
-                if flags:
-                    flags = tuple(map(lambda x: x.decode("utf-8"), flags))
+            if prefilter is not None:
+                fetch_data = filter_fetch_data(fetch_data, prefilter)
 
-                try:
-                    mail = message_from_bytes(fetch[1])  # type: EmailMessage
-                except AttributeError as e:
-                    print(f"\nMail parsing error: {e}", end="")
-                    if self.verbose:
-                        print(f"\n  Mail content:\n  {fetch}")
-                    else:
-                        print(". (Add --verbose to check the mail content)")
-                    continue
+            yield request, parse_fetch_data(fetch_data)
 
-                subject, encoding = decode_header(mail.get("Subject"))[0]
-                if encoding:
-                    if not encoding.startswith('unknown'):
-                        subject = subject.decode(encoding)
-                    else:
-                        subject = str(subject)
-                elif type(subject) == bytes:
-                    subject = subject.decode()
+    def fetch_parallel(self, requests, folder):
+        """Fetch messages on background read-only connections, to overlap the server responses with their processing.
 
-                is_flagged = "\\Flagged" in flags
+        The requests are dealt between the connections, and the responses are returned in the requests order. The
+        extractor connection stays available for the APPEND and STORE commands, unless a background connection fails:
+        its remaining requests are then fetched on the extractor connection.
 
-                mail_date = mail.get("Date", None)
-                date_match = re.match("^(.*\d{4} \d{2}:\d{2}:\d{2}).*$", mail_date)
-                if date_match:
-                    mail_date = date_match.group(1)
+        :param list requests: Requests tuples, starting with the message set and the message data item names.
+        :param str folder: The selected folder.
+        :return: A generator of (request, responses) tuples, responses as returned by parse_fetch_data.
+        """
+        nb_messages = sum(request[0].count(b',') + 1 for request in requests)
+        nb_connections = min(FETCH_CONNECTIONS, nb_messages // FETCH_CONNECTION_MESSAGES, len(requests))
+        if nb_connections < 1:
+            # not worth opening a connection
+            yield from self.fetch_pipeline(requests)
+            return
 
-                try:
-                    mail_date = datetime.strptime(mail_date, "%a, %d %b %Y %H:%M:%S")
-                except ValueError:
-                    mail_date = datetime.strptime(mail_date, "%d %b %Y %H:%M:%S")
+        cancelled = threading.Event()
+        results = [queue.Queue(maxsize=PIPELINE_DEPTH) for i in range(nb_connections)]
+        for i in range(nb_connections):
+            threading.Thread(target=self.fetch_worker, args=(requests[i::nb_connections], folder, results[i], cancelled), daemon=True).start()
 
-                if dates is not None:
-                    date_ok = False
-                    check_date = mail_date.strftime("%Y-%m-%d")
+        try:
+            # round-robin on the workers results, following the requests order
+            workers = list(results)
+            while workers:
+                for worker in list(workers):
+                    result = worker.get()
+                    if result is None:
+                        workers.remove(worker)
+                        continue
 
-                    if dates[0]:
-                        date_ok = check_date == dates[0]
-                    else:
-                        if dates[1] and not dates[2]:
-                            date_ok = check_date >= dates[1]
-                        elif dates[2] and not dates[1]:
-                            date_ok = check_date <= dates[2]
-                        elif dates[1] and dates[2]:
-                            date_ok = dates[1] <= check_date <= dates[2]
-
-                    if not date_ok:
-                        if self.verbose:
-                            print("\nSkip email: '%s' [%s] (possible previous extract)." % (subject, mail_date))
+                    request, responses = result
+                    if request is None:
+                        # failed connection, fetch its remaining requests on the extractor connection
+                        yield from self.fetch_pipeline(responses)
                         continue
 
-                new_mail = EmailMessage()
-                new_mail._headers = mail._headers
+                    yield result
+        finally:
+            # stop the workers, and unblock those waiting for room in their queue
+            cancelled.set()
+            for worker in results:
+                while not worker.empty():
+                    worker.get_nowait()
+
+    def fetch_worker(self, requests, folder, results, cancelled):
+        """Fetch messages on a dedicated read-only connection.
+
+        :param list requests: Requests tuples, starting with the message set and the message data item names.
+        :param str folder: The selected folder.
+        :param queue.Queue results: The queue receiving the (request, responses) tuples, then None when finished. On
+            connection error, (None, remaining requests) is sent before None.
+        :param threading.Event cancelled: Set when the results are not needed anymore.
+        """
+        imap = None
+        answered = []
+        try:
+            imap = self.open_connection()
+            status, select_data = imap.select(imaputf7encode(folder), readonly=True)
+            if status != "OK":
+                raise RuntimeWarning("Could not select %s" % folder)
+
+            for result in self.fetch_pipeline(requests, imap, answered=answered):
+                if cancelled.is_set():
+                    break
+                results.put(result)
+        except (IMAP4.error, OSError, RuntimeWarning) as e:
+            print("Fetch connection error: %s, continue on the main connection." % repr(e))
+            if not cancelled.is_set():
+                answered_ids = set(map(id, answered))
+                remaining = [request for request in requests if id(request) not in answered_ids]  # including the requests in flight
+                results.put((None, remaining))
+        finally:
+            results.put(None)
+
+        if imap is not None:
+            try:
+                imap.logout()
+            except (IMAP4.error, OSError):
+                pass
 
-                has_alternative = False
-                nb_alternative = 0
-                nb_extraction = 0
-                part_nb = 1
+    def is_extractable(self, part):
+        """Check if a BODYSTRUCTURE part is an attachment candidate for extraction.
 
-                to_print = []  # print buffer
+        Same selection as the detached messages parts: only the parts with an attachment disposition are extracted.
 
-                to_print.append("")
-                to_print.append("Parsing mail: '%s' [%s]" % (subject, mail_date))
-                if is_flagged and 'skip' == self.flagged_action:
-                    if self.verbose:
-                        to_print.append("  Skip flagged mail.")
-                    continue
+        :param BodyPart part: The part, as returned by parse_bodystructure.
+        :rtype: bool
+        """
+        if part.disposition != "attachment":
+            return False
 
-                for part in mail.walk():  # type: Message
-                    if part.get_content_type().startswith("multipart/"):
-                        if part.get_content_type() == "multipart/alternative":
-                            new_mail.attach(part)  # add text/plain and text/html alternatives
-                            has_alternative = True
-                        continue
+        size = part.size
+        if part.encoding == "base64":
+            size = size * 3 // 4  # decoded size upper bound
 
-                    if has_alternative and nb_alternative < 2 and (part.get_content_type() == "text/plain" or part.get_content_type() == "text/html"):
-                        nb_alternative = nb_alternative + 1
-                        continue  # text/plain and text/html already added in multipart/alternative
+        return size >= self.max_size
 
-                    is_attachment = part.get_content_disposition() is not None and part.get_content_disposition().startswith("attachment")
-                    if not is_attachment:
-                        new_mail.attach(part)
-                        continue
+    def detach_attachments(self, uid, flags, items, subject, mail_date, folder):
+        """Extract the attachments of a message, and replace it on the server by the detached message.
 
-                    part_nb = part_nb + 1
+        :param bytes uid: The message id.
+        :param tuple flags: The message flags.
+        :param dict items: The message FETCH data items, containing the whole message.
+        :param str subject: The message subject.
+        :param datetime mail_date: The message date, or None.
+        :param str folder: The selected folder.
+        """
+        if b'FLAGS' in items:
+            flags = tuple(map(lambda x: x.decode("utf-8"), items[b'FLAGS']))
 
-                    if not part.get_filename():
-                        attachment_filename = "part.%d" % part_nb
-                    else:
-                        attachment_filename, encoding = decode_header(part.get_filename())[0]
-                        if encoding:
-                            attachment_filename = attachment_filename.decode(encoding)
-                        elif type(attachment_filename) == bytes:
-                            attachment_filename = attachment_filename.decode()
-
-                    if "AttachmentDetached" in part.get("X-Mozilla-Altered", ""):
-                        if self.verbose:
-                            to_print.append("  Attachment '%s' already detached." % attachment_filename)
-                        continue
+        is_flagged = "\\Flagged" in flags
+        if is_flagged and 'skip' == self.flagged_action:
+            # flagged since the message list was fetched
+            if self.verbose:
+                print("\nSkip flagged mail %s." % uid.decode())
+            return
 
-                    if part.get("Content-Transfer-Encoding", "").lower() == "base64":
-                        try:
-                            attachment_content = b64decode(part.get_payload())
-                        except BinasciiError:
-                            to_print.append("  Error when decoding attachment '%s', leave intact." % attachment_filename)
-                            new_mail.attach(part)
-                            continue
-                    else:
-                        if isinstance(part.get_payload(), list):
-                            attachment_content = part.get_payload(1).encode("utf-8")
-                        else:
-                            attachment_content = part.get_payload().encode("utf-8")
+        try:
+            mail = BytesParser(policy=policy.compat32).parsebytes(items[b'BODY[]'])  # type: Message
+        except (KeyError, AttributeError) as e:
+            print(f"\nMail parsing error: {e}", end="")
+            if self.verbose:
+                print(f"\n  Mail content:\n  {items}")
+            else:
+                print(". (Add --verbose to check the mail content)")
+            return
 
-                    attachment_size = len(attachment_content)
+        replacements = {}  # detached parts by id, replaced by a Thunderbird detached part or removed if None
 
-                    if attachment_size < self.max_size:
-                        if self.verbose:
-                            to_print.append("  Attachment '%s' size (%s) is smaller than defined threshold (%s), leave intact." % (attachment_filename, human_readable_size(attachment_size), human_readable_size(self.max_size)))
-                        new_mail.attach(part)
-                        continue
+        nb_extraction = 0
+        part_nb = 1
 
-                    filename = "%s - %s" % (mail_date.strftime("%Y-%m-%d"), attachment_filename)
-                    idx = 0
-                    while os.path.exists(os.path.join(self.extract_dir, filename)):
-                        idx = idx + 1
-                        filename = re.sub("^(\d{4}-\d{2}-\d{2}) (?:\(\d+\) )?- (.*)$", "\g<1> (%02d) - \g<2>" % idx, filename)
+        to_print = []  # print buffer
 
-                    if not self.dry_run:
-                        with open(os.path.join(self.extract_dir, filename), "wb") as file:
-                            file.write(attachment_content)
+        to_print.append("")
+        to_print.append("Parsing mail: '%s' [%s]" % (subject, mail_date))
 
-                        to_print.append("  Extracted '%s' (%s) to '%s'" % (attachment_filename, human_readable_size(attachment_size), os.path.join(self.extract_dir, filename)))
-                    else:
-                        to_print.append("  [Dry-run] Extracted '%s' (%s) to '%s'" % (attachment_filename, human_readable_size(attachment_size), os.path.join(self.extract_dir, filename)))
+        for part in leaf_parts(mail):  # type: Message
+            if part.get_content_disposition() != "attachment":
+                continue
 
-                    self.extracted_nb = self.extracted_nb + 1
-                    self.extracted_size = self.extracted_size + attachment_size
+            part_nb = part_nb + 1
 
-                    nb_extraction = nb_extraction + 1
+            part_filename = part.get_filename()
+            if not part_filename:
+                attachment_filename = "part.%d" % part_nb
+            else:
+                attachment_filename, encoding = decode_header(part_filename)[0]
+                if encoding:
+                    attachment_filename = attachment_filename.decode(encoding)
+                elif isinstance(attachment_filename, bytes):
+                    attachment_filename = attachment_filename.decode()
+
+            mozilla_altered = part.get("X-Mozilla-Altered")
+            if mozilla_altered is not None and "AttachmentDetached" in mozilla_altered:
+                if self.verbose:
+                    to_print.append("  Attachment '%s' already detached." % attachment_filename)
+                continue
 
-                    if self.thunderbird_mode and ('detach' == self.flagged_action or not is_flagged):
-                        # replace attachement by local file URL
-                        headers_str = ""
-                        try:
-                            headers_str = "\n".join(map(lambda x: x[0]+": "+x[1], part._headers))
-                        except Exception as e:
-                            to_print.append("  Error when serializing headers: %s" % repr(e))
+            if part.is_multipart():
+                attachment_content = part.get_payload(0).as_bytes()  # attached message/rfc822
+                encoding = None
+            elif part.get("Content-Transfer-Encoding", "").lower() == "base64":
+                attachment_content = part.get_payload()  # decoded by chunks while writing
+                encoding = "base64"
+            else:
+                attachment_content = part.get_payload(decode=True)
+                encoding = None
 
-                        new_part = Message()
-                        new_part._headers = part._headers
-                        new_part.set_payload("You deleted an attachment from this message. The original MIME headers for the attachment were:\n%s" % headers_str)
+            filename, attachment_size = self.save_attachment(attachment_content, encoding, mail_date, attachment_filename, to_print)
+            if filename is None:
+                continue
 
-                        new_part.replace_header("Content-Transfer-Encoding", "")
-                        url_path = "file:///%s/%s" % (self.extract_dir.replace("\\", "/"), filename)
-                        new_part.add_header("X-Mozilla-External-Attachment-URL", url_path)
-                        new_part.add_header("X-Mozilla-Altered",  'AttachmentDetached; date=%s' % Time2Internaldate(time()))
+            self.extracted_nb = self.extracted_nb + 1
+            self.extracted_size = self.extracted_size + attachment_size
 
-                        new_mail.attach(new_part)
+            nb_extraction = nb_extraction + 1
 
-                if nb_extraction:
-                    self.extracted_from_nb = self.extracted_from_nb + 1
+            if self.thunderbird_mode and ('detach' == self.flagged_action or not is_flagged):
+                # replace attachement by local file URL
+                headers_str = ""
+                try:
+                    headers_str = "\n".join(map(lambda x: x[0]+": "+x[1], part._headers))
+                except Exception as e:
+                    to_print.append("  Error when serializing headers: %s" % repr(e))
 
-                if to_print:
-                    if nb_extraction > 0 or self.verbose:
-                        print("\n".join(to_print))
+                new_part = Message()
+                new_part._headers = list(part._headers)
+                new_part.set_payload("You deleted an attachment from this message. The original MIME headers for the attachment were:\n%s" % headers_str)
 
-                if nb_extraction > 0 and not self.extract_only and ('detach' == self.flagged_action or not is_flagged):
-                    if not self.dry_run:
-                        print("  Extracted %s attachment%s, replacing email." % (nb_extraction, "s" if nb_extraction > 1 else ""))
-                        status, append_data = self.imap.append(imaputf7encode(folder), " ".join(flags), mail_date.astimezone() if mail_date else '', new_mail.as_bytes(policy=policy.SMTPUTF8))
-                        if status != "OK":
-                            print("  Could not append message to IMAP server.")
-                            continue
+                new_part.replace_header("Content-Transfer-Encoding", "")
+                url_path = "file:///%s/%s" % (self.extract_dir.replace("\\", "/"), filename)
+                new_part.add_header("X-Mozilla-External-Attachment-URL", url_path)
+                new_part.add_header("X-Mozilla-Altered",  'AttachmentDetached; date=%s' % Time2Internaldate(time()))
 
-                        if self.verbose:
-                            print("  Append message on IMAP server.")
-                    else:
-                        print("  [Dry-run] Extracted %s attachment%s, replacing email." % (nb_extraction, "s" if nb_extraction > 1 else ""))
+                replacements[id(part)] = new_part
+            else:
+                replacements[id(part)] = None
 
-                        if self.verbose:
-                            print("  [Dry-run] Append message on IMAP server.")
+        if nb_extraction:
+            self.extracted_from_nb = self.extracted_from_nb + 1
 
-                    if not self.debug and not self.dry_run:
-                        status, store_data = self.imap.store(uid, '+FLAGS', '\Deleted')
-                        if status != "OK":
-                            print("  Could not delete original message from IMAP server.")
-                            continue
+        if to_print:
+            if nb_extraction > 0 or self.verbose:
+                print("\n".join(to_print))
 
-                        if self.verbose:
-                            print("  Delete original message.")
+        if nb_extraction > 0 and ('detach' == self.flagged_action or not is_flagged):
+            if not self.dry_run:
+                print("  Extracted %s attachment%s, replacing email." % (nb_extraction, "s" if nb_extraction > 1 else ""))
+                new_mail = rebuild_message(mail, replacements)
+                if new_mail is None:  # the whole message was a removed attachment
+                    new_mail = Message()
+                    new_mail._headers = [(k, v) for k, v in mail._headers if not k.lower().startswith("content-")]
+                    new_mail.set_payload("")
+
+                status, append_data = self.append_message(folder, flags, mail_date, new_mail)
+                if status != "OK":
+                    print("  Could not append message to IMAP server.")
+                    return
+
+                if self.verbose:
+                    print("  Append message on IMAP server.")
+            else:
+                print("  [Dry-run] Extracted %s attachment%s, replacing email." % (nb_extraction, "s" if nb_extraction > 1 else ""))
 
-                    elif self.dry_run:
-                        if self.verbose:
-                            print("  [Dry-run] Delete original message.")
-                    else:
-                        print("  Debug: would delete original message.")
+                if self.verbose:
+                    print("  [Dry-run] Append message on IMAP server.")
 
-                elif self.extract_only and nb_extraction > 0:
-                    print("  Extracted %s attachment%s." % (nb_extraction, "s" if nb_extraction > 1 else ""))
-                elif 'extract' == self.flagged_action:
-                    if self.verbose:
-                        print("  Flagged message, leave intact.")
-                else:
-                    if nb_extraction > 0 or self.verbose:
-                        print("  Nothing extracted.")
+            if not self.debug and not self.dry_run:
+                self.deleted_uids.append(uid)  # deleted by batches at the end of the extraction
 
-        print()
-        print('Extract finished.')
+                if self.verbose:
+                    print("  Delete original message.")
 
-        if self.extracted_size > 0:
-            if not self.dry_run:
-                print("  Extracted %d files from %s messages, %s gain." % (self.extracted_nb, self.extracted_from_nb, human_readable_size(self.extracted_size)))
+            elif self.dry_run:
+                if self.verbose:
+                    print("  [Dry-run] Delete original message.")
             else:
-                print("  [Dry-run] Extracted %d files from %s messages, %s gain." % (self.extracted_nb, self.extracted_from_nb, human_readable_size(self.extracted_size)))
+                print("  Debug: would delete original message.")
 
+        elif nb_extraction > 0:
+            # flagged since the message list was fetched, with the 'extract' flagged action
+            print("  Extracted %s attachment%s." % (nb_extraction, "s" if nb_extraction > 1 else ""))
             if self.verbose:
-                print("  Thunderbird headers used: %s." % ("yes" if self.thunderbird_mode else "no"))
+                print("  Flagged message, leave intact.")
+        elif self.verbose:
+            print("  Nothing extracted.")
+
+    def extract_parts(self, uid, flags, parts, items, subject, mail_date):
+        """Extract the attachments of a message left intact on the server, from the fetched parts only.
+
+        :param bytes uid: The message id.
+        :param tuple flags: The message flags.
+        :param list parts: The attachment parts to extract, as returned by parse_bodystructure.
+        :param dict items: The message FETCH data items, containing the attachment parts.
+        :param str subject: The message subject.
+        :param datetime mail_date: The message date, or None.
+        """
+        if not items:
+            print("Could not fetch message %s." % uid.decode())
+            return
 
-        print()
+        nb_extraction = 0
+
+        to_print = []  # print buffer
+
+        to_print.append("")
+        to_print.append("Parsing mail: '%s' [%s]" % (subject, mail_date))
+
+        for section, content_type, encoding, size, disposition, attachment_filename in parts:
+            if not attachment_filename:
+                attachment_filename = "part.%s" % section
+
+            # non-compliant servers answer with the requested BINARY.PEEK data item name
+            attachment_content = items.get(b'BINARY[%s]' % section.encode(), items.get(b'BINARY.PEEK[%s]' % section.encode()))
+            if attachment_content is not None:
+                encoding = None  # already decoded by the server
+            else:
+                attachment_content = items.get(b'BODY[%s]' % section.encode())
+
+            if attachment_content is None:
+                to_print.append("  Could not fetch attachment '%s'." % attachment_filename)
+                continue
+
+            filename, attachment_size = self.save_attachment(attachment_content, encoding, mail_date, attachment_filename, to_print)
+            if filename is None:
+                continue
+
+            self.extracted_nb = self.extracted_nb + 1
+            self.extracted_size = self.extracted_size + attachment_size
+
+            nb_extraction = nb_extraction + 1
+
+        if nb_extraction:
+            self.extracted_from_nb = self.extracted_from_nb + 1
+
+        if nb_extraction > 0 or self.verbose:
+            print("\n".join(to_print))
+
+        if nb_extraction > 0:
+            print("  Extracted %s attachment%s." % (nb_extraction, "s" if nb_extraction > 1 else ""))
+            if not self.extract_only and self.verbose:
+                print("  Flagged message, leave intact.")
+        elif self.verbose:
+            print("  Nothing extracted.")
+
+    def save_attachment(self, content, encoding, mail_date, attachment_filename, to_print):
+        """Decode an attachment to the extract dir, if bigger than the size threshold.
+
+        :param bytes|str content: The attachment content.
+        :param str encoding: The attachment Content-Transfer-Encoding, None to save the content as is.
+        :param datetime mail_date: The message date.
+        :param str attachment_filename: The attachment filename.
+        :param list to_print: The message print buffer.
+        :return: The extract filename and the decoded size, or (None, None) if the attachment is left intact.
+        :rtype: (str, int)
+        """
+        # the base64 length is an upper bound of the decoded size, skip small attachments without decoding them
+        attachment_size = len(content) * 3 // 4 if encoding == "base64" else len(content)
+
+        if attachment_size >= self.max_size:
+            filename = self.unique_filename(mail_date, attachment_filename)
+            path = os.path.join(self.extract_dir, filename)
+
+            try:
+                with open(path if not self.dry_run else os.devnull, "wb", buffering=0) as file:
+                    attachment_size = decode_to_file(content, encoding, file)
+            except BinasciiError:
+                if not self.dry_run:
+                    os.remove(path)
+                to_print.append("  Error when decoding attachment '%s', leave intact." % attachment_filename)
+                return None, None
+
+            if attachment_size < self.max_size and not self.dry_run:
+                os.remove(path)
+
+        if attachment_size < self.max_size:
+            if self.verbose:
+                to_print.append("  Attachment '%s' size (%s) is smaller than defined threshold (%s), leave intact." % (attachment_filename, human_readable_size(attachment_size), human_readable_size(self.max_size)))
+            return None, None
+
+        if not self.dry_run:
+            self.keep_filename(mail_date, attachment_filename)
+            to_print.append("  Extracted '%s' (%s) to '%s'" % (attachment_filename, human_readable_size(attachment_size), path))
+        else:
+            to_print.append("  [Dry-run] Extracted '%s' (%s) to '%s'" % (attachment_filename, human_readable_size(attachment_size), path))
+
+        return filename, attachment_size
+
+    @staticmethod
+    def mail_info(mail):
+        """Get the decoded subject and the date of a message.
+
+        :param EmailMessage mail: The message headers, parsed with the default policy.
+        :return: The subject and the date, None if missing or invalid.
+        :rtype: (str, datetime)
+        """
+        subject = str(mail.get("Subject", ""))
+
+        try:
+            mail_date = mail["Date"].datetime
+        except (AttributeError, TypeError, ValueError):  # missing, or invalid with older Python versions
+            mail_date = None
+
+        if mail_date is None:
+            print("Could not parse date of message '%s'." % subject)
+
+        return subject, mail_date
+
+    @staticmethod
+    def date_in_range(mail_date, dates):
+        """Check a message date against the searched dates.
+
+        :param datetime mail_date: The message date, or None.
+        :param tuple dates: The ON, SINCE, and BEFORE dates formatted as y-m-d, or None.
+        :rtype: bool
+        """
+        if dates is None or mail_date is None:
+            return True
+
+        date_ok = False
+        check_date = mail_date.strftime("%Y-%m-%d")
+
+        if dates[0]:
+            date_ok = check_date == dates[0]
+        else:
+            if dates[1] and not dates[2]:
+                date_ok = check_date >= dates[1]
+            elif dates[2] and not dates[1]:
+                date_ok = check_date <= dates[2]
+            elif dates[1] and dates[2]:
+                date_ok = dates[1] <= check_date <= dates[2]
+
+        return date_ok
+
+    def index_extract_dir(self):
+        """Index the extract filenames already existing in the extract dir.
+
+        :return: The next free filename index by (date, attachment filename).
+        :rtype: dict
+        """
+        filename_index = {}
+        if not os.path.isdir(self.extract_dir):
+            return filename_index
+
+        with os.scandir(self.extract_dir) as entries:
+            for entry in entries:
+                match = FILENAME_INDEX_REGEX.match(entry.name)
+                if match:
+                    key = (match.group(1), os.path.normcase(match.group(3)))
+                    filename_index[key] = max(filename_index.get(key, 0), int(match.group(2) or 0) + 1)
+
+        return filename_index
+
+    def unique_filename(self, mail_date, attachment_filename):
+        """Get an extract filename not already existing in the extract dir.
+
+        The filename is only reserved by keep_filename, once the extracted file is kept.
+
+        :param datetime mail_date: The message date.
+        :param str attachment_filename: The attachment filename.
+        :return: The filename, relative to the extract dir.
+        :rtype: str
+        """
+        if self.filename_index is None:
+            self.filename_index = self.index_extract_dir()
+
+        day = mail_date.strftime("%Y-%m-%d") if mail_date else "0000-00-00"
+        idx = self.filename_index.get((day, os.path.normcase(attachment_filename)), 0)
+
+        if idx:
+            return "%s (%02d) - %s" % (day, idx, attachment_filename)
+
+        return "%s - %s" % (day, attachment_filename)
+
+    def keep_filename(self, mail_date, attachment_filename):
+        """Reserve the extract filename returned by unique_filename, so that the next one gets the next index.
+
+        :param datetime mail_date: The message date.
+        :param str attachment_filename: The attachment filename.
+        """
+        day = mail_date.strftime("%Y-%m-%d") if mail_date else "0000-00-00"
+        key = (day, os.path.normcase(attachment_filename))
+        self.filename_index[key] = self.filename_index.get(key, 0) + 1
 
     def connect(self):
+        """Connect and login to the IMAP server, or reuse a pooled connection."""
         if self.password is None:
             if self.ask_password:
                 # prompt for password
                 self.password = getpass.getpass()
             else:
-                # fetch password from keyring
+                # fetch password from keyring, only imported when needed as it is slow to load
+                import keyring
                 self.password = keyring.get_password("imap_aex:%s" % self.host, self.login)
                 if not self.password:
                     raise RuntimeWarning("Password not found for user {user} on {host} . Use 'keyring set imap_aex:{host} {user}' to set.".format(host=self.host, user=self.login))
 
-        # connect to host
-        self.imap = IMAP4_SSL(host=self.host, port=self.port)
-        login_status, login_details = self.imap.login(self.login, self.password)
+        # reuse pooled connection
+        if not self.owns_connection:
+            with self.connection_pool_lock:
+                self.imap, self.last_activity = self.connection_pool.pop((self.host, self.port, self.login), (None, 0))
+
+            if self.imap is not None:
+                self.ensure_connected()
+                return
+
+        self.imap = self.open_connection()
+        self.last_activity = time()
+
+    def open_connection(self):
+        """Open a new connection to the IMAP server, and login.
+
+        :return: The logged in connection.
+        :rtype: IMAP4
+        """
+        imap = ImapConnection(host=self.host, port=self.port)
+        login_status, login_details = imap.login(self.login, self.password)
         if login_status != 'OK':
             raise RuntimeWarning("Could not login %s on %s:%s : %s " % (self.login, self.host, self.port, login_details))
 
+        # capabilities may change once authenticated
+        capability_status, capability_data = imap.capability()
+        if capability_status == 'OK' and capability_data[-1]:
+            imap.capabilities = tuple(capability_data[-1].decode().upper().split())
+
+        return imap
+
+    def ensure_connected(self):
+        """Connect if needed, or check the connection with a NOOP after a long inactivity, reconnecting if aborted."""
+        if self.imap is not None and time() - self.last_activity > NOOP_INTERVAL:
+            try:
+                self.imap.noop()
+            except (IMAP4.abort, OSError):
+                self.imap = None
+
+        if self.imap is None:
+            self.connect()
+
+        self.last_activity = time()
+
+    @classmethod
+    def close_connection_pool(cls):
+        """Logout from all the pooled connections.
+
+        Called at exit, or by a library user to release the connections earlier.
+        """
+        with cls.connection_pool_lock:
+            connections = list(cls.connection_pool.values())
+            cls.connection_pool.clear()
+
+        for imap, last_activity in connections:
+            try:
+                imap.logout()
+            except (IMAP4.error, OSError):
+                pass
+
     def __enter__(self):
         self.connect()
 
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.imap.state == "SELECTED":
-            self.imap.expunge()
-            self.imap.close()
+        if self.imap is None:
+            return
+
+        try:
+            if self.imap.state == "SELECTED":
+                self.imap.expunge()
+                self.imap.close()
+        except IMAP4.abort:
+            self.imap = None
+            return
+
+        if self.owns_connection:
             self.imap.logout()
+        else:
+            # keep the connection for the next extractor on the same account
+            with self.connection_pool_lock:
+                self.connection_pool[(self.host, self.port, self.login)] = (self.imap, time())
+
+        self.imap = None
+
+
+atexit.register(ImapAttachmentExtractor.close_connection_pool)
 
 
 def human_readable_size(num, suffix='B'):
@@ -675,7 +1156,7 @@ def human_readable_size(num, suffix='B'):
     :return: Formatted string representation of the size.
     :rtype: str
     """
-    for unit in ['', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']:
+    for unit in SIZE_UNITS:
         if abs(num) < 1024.0:
             return "%3.1f%s%s" % (num, unit, suffix)
         num /= 1024.0
@@ -695,86 +1176,446 @@ def human_readable_size_to_bytes(size_label, suffix='B'):
 
     size_label = size_label.upper()
 
-    match = re.match("^(\d[\d.]*)(K|M|G|T|P|E|Z)?(%s)?$" % suffix, size_label)
+    match = SIZE_LABEL_REGEX.match(size_label)
 
     if not match:
         raise SyntaxWarning("Wrong size %s." % size_label)
     if match.group(3) and match.group(3) != suffix:
         raise SyntaxWarning("Invalid suffix %s." % match.group(3))
 
-    size, unit = float(match.group(1)), match.group(2)
-
-    if unit in ['K', 'M', 'G', 'T', 'P', 'E', 'Z']:
-        size *= 1024
-    if unit in ['M', 'G', 'T', 'P', 'E', 'Z']:
-        size *= 1024
-    if unit in ['G', 'T', 'P', 'E', 'Z']:
-        size *= 1024
-    if unit in ['T', 'P', 'E', 'Z']:
-        size *= 1024
-    if unit in ['P', 'E', 'Z']:
-        size *= 1024
-    if unit in ['E', 'Z']:
-        size *= 1024
-    if unit in ['Z']:
-        size *= 1024
-
-    size = int(size)
+    size = int(float(match.group(1)) * (1 << SIZE_UNIT_SHIFTS[match.group(2) or '']))
 
     return size
 
 
+@lru_cache(maxsize=256)
+def folder_subdir(folder, dir_reg):
+    """Get the extract subdirectory of a folder, after applying the directory regexes.
+
+    :param str folder: The folder name.
+    :param tuple dir_reg: The (compiled pattern, replacement) tuples to apply.
+    :return: The subdirectory path, '/' separated.
+    :rtype: str
+    """
+    for pattern, replacement in dir_reg:
+        folder = pattern.sub(replacement, folder)
+
+    return folder
+
+
+_LIST_START = object()
+_LIST_END = object()
+
+
+def tokenize_fetch_data(fetch_data):
+    """Tokenize the data returned by an imaplib FETCH command.
+
+    :param list fetch_data: The FETCH response data, a list of bytes and (bytes, literal) tuples.
+    :return: A generator of tokens: list start and end markers, atoms and strings as bytes, literals, None for NIL.
+    """
+    for piece in fetch_data:
+        if isinstance(piece, tuple):
+            line, literal = piece
+        else:
+            line, literal = piece, None
+
+        if line is None:
+            continue
+
+        i = 0
+        n = len(line)
+        while i < n:
+            c = line[i]
+            if c == 0x20:  # space
+                i = i + 1
+            elif c == 0x28:  # (
+                yield _LIST_START
+                i = i + 1
+            elif c == 0x29:  # )
+                yield _LIST_END
+                i = i + 1
+            elif c == 0x22:  # quoted string
+                value = bytearray()
+                i = i + 1
+                while line[i] != 0x22:
+                    if line[i] == 0x5c:  # backslash escape
+                        i = i + 1
+                    value.append(line[i])
+                    i = i + 1
+                yield bytes(value)
+                i = i + 1
+            elif c in b'{~' and literal is not None:  # {size} or ~{size} binary literal marker, ends the line
+                yield literal
+                i = n
+            else:  # atom, possibly with a [section] spec
+                j = i
+                while j < n and line[j] not in b' ()':
+                    if line[j] == 0x5b:  # [
+                        j = line.index(b']', j)
+                    j = j + 1
+                atom = line[i:j]
+                yield None if atom.upper() == b'NIL' else atom
+                i = j
+
+
+try:
+    # compiled tokenizer, built by setup.py when Cython is available
+    from imap_aex_speedups import tokenize_fetch_data, LIST_START as _LIST_START, LIST_END as _LIST_END
+except ImportError:
+    pass
+
+
+def without_binary(request):
+    """Replace the BINARY.PEEK data items of a FETCH request by BODY.PEEK, to decode the parts client side.
+
+    :param tuple request: The request tuple, starting with the message set and the message data item names.
+    :return: The request tuple.
+    :rtype: tuple
+    """
+    return (request[0], request[1].replace('BINARY.PEEK[', 'BODY.PEEK[')) + tuple(request[2:])
+
+
+def filter_fetch_data(fetch_data, prefilter):
+    """Filter the data returned by an imaplib FETCH command, without parsing it.
+
+    :param list fetch_data: The FETCH response data.
+    :param re.Pattern prefilter: The bytes regex to search for.
+    :return: The FETCH response data of the messages matching the regex.
+    :rtype: list
+    """
+    filtered = []
+    message = []
+    found = False
+    for piece in fetch_data:
+        line = piece[0] if isinstance(piece, tuple) else piece
+        if line is None:
+            continue
+
+        if line[:1].isdigit():  # start of the next message response, continuation lines follow a literal
+            if found:
+                filtered.extend(message)
+            message = []
+            found = False
+
+        message.append(piece)
+        if not found:
+            found = prefilter.search(line) is not None
+
+    if found:
+        filtered.extend(message)
+
+    return filtered
+
+
+def parse_fetch_data(fetch_data):
+    """Parse the data returned by an imaplib UID FETCH command.
+
+    The responses without UID data item are unsolicited, like the flags updates made by other clients, and are
+    dropped: their message sequence number could be mistaken for the UID of a fetched message.
+
+    :param list fetch_data: The FETCH response data.
+    :return: A list of (UID, items) tuples, with items a dict of the FETCH data items keyed by upper-case name.
+    :rtype: list[(bytes, dict)]
+    """
+    tokens = tokenize_fetch_data(fetch_data)
+
+    def parse_list():
+        values = []
+        for token in tokens:
+            if token is _LIST_END:
+                break
+            values.append(parse_list() if token is _LIST_START else token)
+        return values
+
+    responses = []
+    for token in tokens:
+        if token is _LIST_START:
+            values = parse_list()
+            items = dict(zip((k.upper() for k in values[0::2]), values[1::2]))
+            if b'UID' in items:
+                responses.append((items[b'UID'], items))
+
+    return responses
+
+
+def parse_bodystructure(structure, section=''):
+    """Flatten a BODYSTRUCTURE into its leaf parts.
+
+    Multipart children are numbered according to RFC 3501 section specification, ie. '1', '1.2', '2'.
+    Encapsulated message/rfc822 parts are not walked into.
+
+    :param list structure: The BODYSTRUCTURE, as parsed by parse_fetch_data.
+    :param str section: The section of the structure. (default: '' for the message itself)
+    :return: The leaf parts.
+    :rtype: list[BodyPart]
+    """
+    if isinstance(structure[0], list):
+        # multipart: body parts followed by the subtype and extension data
+        parts = []
+        for i, child in enumerate(structure, 1):
+            if not isinstance(child, list):
+                break
+            parts.extend(parse_bodystructure(child, "%s.%d" % (section, i) if section else str(i)))
+        return parts
+
+    content_type = (b'%s/%s' % (structure[0], structure[1])).decode("utf-8", "replace").lower()
+    params = structure[2] if isinstance(structure[2], list) else []
+    encoding = (structure[5] or b'').decode("utf-8", "replace").lower()
+    size = int(structure[6])
+
+    # extension data position depends on the body type
+    if content_type.startswith("text/"):
+        extension = 8
+    elif content_type == "message/rfc822":
+        extension = 10
+    else:
+        extension = 7
+
+    disposition = None
+    filename = None
+    if len(structure) > extension + 1 and isinstance(structure[extension + 1], list):
+        disposition_type, disposition_params = structure[extension + 1][0], structure[extension + 1][1]
+        disposition = disposition_type.decode("utf-8", "replace").lower()
+        if isinstance(disposition_params, list):
+            params = disposition_params + params  # disposition filename takes precedence over content type name
+    elif len(structure) > extension + 1 and structure[extension + 1]:
+        # non-compliant server sending the raw Content-Disposition header value
+        part = Message()
+        part["Content-Disposition"] = structure[extension + 1].decode("utf-8", "replace")
+        disposition = part.get_content_disposition()
+        filename = part.get_filename()
+        if filename:
+            params = []
+
+    for key, value in zip(params[0::2], params[1::2]):
+        key = key.lower()
+        if key in (b'filename', b'name') and value:
+            filename, charset = decode_header(value.decode("utf-8", "replace"))[0]
+            if charset:
+                filename = filename.decode(charset, "replace")
+            elif isinstance(filename, bytes):
+                filename = filename.decode()
+            break
+        elif key in (b'filename*', b'name*') and value:
+            charset, language, filename = decode_rfc2231(value.decode("utf-8", "replace"))
+            filename = unquote(filename, encoding=charset or "utf-8", errors="replace")
+            break
+
+    return [BodyPart(section or '1', content_type, encoding, size, disposition, filename)]
+
+
+def leaf_parts(part):
+    """Walk the leaf parts of a message.
+
+    Unlike Message.walk, the multipart containers are not returned, and encapsulated message/rfc822 parts are not
+    walked into.
+
+    :param Message part: The message.
+    :return: A generator of the leaf parts.
+    """
+    if part.get_content_maintype() == "multipart" and part.is_multipart():
+        for child in part.get_payload():
+            yield from leaf_parts(child)
+    else:
+        yield part
+
+
+def rebuild_message(part, replacements):
+    """Copy the structure of a message, replacing some of its leaf parts.
+
+    :param Message part: The message.
+    :param dict replacements: The replacing parts by replaced part id, None to remove the part.
+    :return: The new message, or None if removed.
+    :rtype: Message
+    """
+    if id(part) in replacements:
+        return replacements[id(part)]
+
+    if part.get_content_maintype() != "multipart" or not part.is_multipart():
+        return part
+
+    container = Message()
+    container._headers = part._headers
+    container.preamble = part.preamble
+    container.epilogue = part.epilogue
+    container.set_payload([])
+    for child in part.get_payload():
+        child = rebuild_message(child, replacements)
+        if child is not None:
+            container.attach(child)
+
+    return container
+
+
+def tune_socket(sock):
+    """Set the socket options of an IMAP connection, ignoring the options unsupported by the platform.
+
+    Nagle's algorithm is disabled not to delay the small pipelined commands. The receive buffer size is left to the
+    system, as setting it disables its automatic tuning.
+
+    :param socket.socket sock: The connection socket.
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+
+def decode_to_file(content, encoding, file):
+    """Decode a transfer-encoded body part to a file, by chunks.
+
+    :param bytes|str content: The encoded body part.
+    :param str encoding: The Content-Transfer-Encoding of the part.
+    :param file: The binary file object to write to, preferably unbuffered.
+    :return: The decoded size.
+    :rtype: int
+    """
+    if encoding == "base64":
+        size = 0
+        remainder = b''
+        for pos in range(0, len(content), DECODE_CHUNK_SIZE):
+            chunk = content[pos:pos + DECODE_CHUNK_SIZE]
+            if isinstance(chunk, str):
+                chunk = chunk.encode("ascii", "ignore")
+
+            chunk = remainder + chunk.translate(None, BASE64_IGNORED)  # drop line breaks and invalid characters
+            end = len(chunk) - len(chunk) % 4  # decode complete base64 quanta only
+            remainder = chunk[end:]
+            decoded = a2b_base64(memoryview(chunk)[:end])
+            write_all(file, decoded)
+            size = size + len(decoded)
+
+        if remainder:
+            raise BinasciiError("Incorrect padding")
+
+        return size
+
+    if encoding == "quoted-printable":
+        size = 0
+        remainder = b''
+        for pos in range(0, len(content), DECODE_CHUNK_SIZE):
+            chunk = remainder + content[pos:pos + DECODE_CHUNK_SIZE]
+            end = chunk.rfind(b'\n') + 1  # decode complete lines only, not to split a soft line break or an escape
+            remainder = chunk[end:]
+            decoded = a2b_qp(chunk[:end])
+            write_all(file, decoded)
+            size = size + len(decoded)
+
+        decoded = a2b_qp(remainder)
+        write_all(file, decoded)
+
+        return size + len(decoded)
+
+    write_all(file, content)
+    return len(content)
+
+
+def write_all(file, data):
+    """Write data to a file, retrying partial writes of unbuffered files.
+
+    :param file: The binary file object to write to.
+    :param bytes data: The data to write.
+    """
+    view = memoryview(data)
+    while view:
+        written = file.write(view)
+        view = view[written:]
+
+
 def b64padanddecode(b):
     """Decode unpadded base64 data"""
-    b += (-len(b) % 4) * '='  # base64 padding (if adds '===', no valid padding anyway)
-    return b64decode(b, altchars='+,', validate=True).decode('utf-16-be')
+    b = b.encode('ascii')
+    b = b + b'==='[:-len(b) % 4]  # base64 padding (if adds '===', no valid padding anyway)
+    return b64decode(b, altchars=IMAP_UTF7_ALTCHARS, validate=True).decode('utf-16-be')
+
 
+def b64encodeunpadded(b):
+    """Encode data to unpadded base64, with the IMAP UTF7 alphabet"""
+    encoded = b64encode(b, altchars=IMAP_UTF7_ALTCHARS)
+    padding = -len(b) % 3
+    return (encoded[:-padding] if padding else encoded).decode('ascii')
 
+
+@lru_cache(maxsize=256)
 def imaputf7decode(s):
     """Decode a string encoded according to RFC2060 aka IMAP UTF7.
 
     Minimal validation of input, only works with trusted data"""
-    lst = s.split('&')
-    out = lst[0]
-    for e in lst[1:]:
-        u, a = e.split('-', 1)  # u: utf16 between & and 1st -, a: ASCII chars folowing it
-        if u == '':
-            out += '&'
-        else:
-            out += b64padanddecode(u)
-        out += a
-    return out
+    if '&' not in s:  # nothing encoded
+        return s
+
+    out = []
+    pos = 0
+    for match in IMAP_UTF7_DECODE_REGEX.finditer(s):
+        out.append(s[pos:match.start()])  # ASCII chars preceding the encoded run
+        out.append(b64padanddecode(match.group(1)) if match.group(1) else '&')
+        pos = match.end()
+
+    out.append(s[pos:])
+    return ''.join(out)
 
 
+@lru_cache(maxsize=256)
 def imaputf7encode(s):
     """"Encode a string into RFC2060 aka IMAP UTF7"""
-    s = s.replace('&', '&-')
-    unipart = out = ''
-    for c in s:
-        if 0x20 <= ord(c) <= 0x7f:
-            if unipart != '':
-                out += '&' + b64encode(unipart.encode('utf-16-be')).decode('ascii').rstrip('=') + '-'
-                unipart = ''
-            out += c
-        else:
-            unipart += c
-    if unipart != '':
-        out += '&' + b64encode(unipart.encode('utf-16-be')).decode('ascii').rstrip('=') + '-'
-    return out
-
+    if '&' not in s and s.isascii() and s.isprintable():  # nothing to encode
+        return s
 
+    s = s.replace('&', '&-')
+    out = []
+    pos = 0
+    for match in IMAP_UTF7_ENCODE_REGEX.finditer(s):
+        out.append(s[pos:match.start()])  # printable ASCII chars preceding the run
+        out.append('&%s-' % b64encodeunpadded(match.group().encode('utf-16-be')))
+        pos = match.end()
+
+    out.append(s[pos:])
+    return ''.join(out)
+
+
+# arguments definition: keyword argument, command line option, configuration section and option, type
+ARGUMENTS = (
+    ('host',              'HOST',              'imap',        'host',           str),
+    ('login',             'USER',              'imap',        'login',          str),
+    ('port',              '--port',            'imap',        'port',           int),
+
+    ('date_def',          '--date',            'parameters',  'date',           str),
+    ('fetch_all',         '--all',             'parameters',  'all',            bool),
+
+    ('folder',            '--folder',          'parameters',  'folder',         str),
+    ('extract_dir',       '--extract-dir',     'parameters',  'extract-dir',    str),
+    ('max_size',          '--max-size',        'parameters',  'max-size',       str),
+    ('flagged_action',    '--flagged',         'parameters',  'flagged',        str),
+    ('dir_reg',           '--dir-reg',         'parameters',  'dir-reg',        str),
+    ('fetch_batch',       '--fetch-batch',     'parameters',  'fetch-batch',    int),
+
+    ('no_subdir',         '--no-subdir',       'options',     'no-subdir',      bool),
+    ('thunderbird_mode',  '--thunderbird',     'options',     'thunderbird',    bool),
+    ('extract_only',      '--extract-only',    'options',     'extract-only',   bool),
+    ('inline_images',     '--inline-images',   'options',     'inline-images',  bool),
+    ('dry_run',           '--dry-run',         'options',     'dry-run',        bool),
+    ('ask_password',      '--password',        'options',     'password',       bool),
+    ('debug',             '--debug',           'options',     'debug',          bool),
+    ('verbose',           '--verbose',         'options',     'verbose',        bool),
+)
+
+
+@lru_cache(maxsize=1)
 def parse_configuration(conf_file='config.ini'):
     """Parse configuration file.
 
     :param str conf_file: The configuration file.
     :return: The config parser, or None if not found.
-    :rype: ConfigParser|None
+    :rtype: ConfigParser|None
     """
-    if not os.path.exists(conf_file):
-        return ConfigParser()
+    try:
+        file = open(conf_file)  # same encoding as ConfigParser.read
+    except OSError:  # missing or unreadable, ignored like ConfigParser.read does
+        return None
 
     config = ConfigParser()
-    config.read(conf_file)
+    with file:
+        config.read_file(file)
     return config
 
 
@@ -784,60 +1625,26 @@ def main(options, defaults):
     list_folders =  options['--list']  # type: bool
     run = options['--run']  # type: bool
 
-    # arguments definition
-    arguments = {
-        ('host',                'HOST',                     '[imap] host',                      str),
-        ('login',               'USER',                     '[imap] login',                     str),
-        ('port',                '--port',                   '[imap] port',                      int),
-
-        ('date_def',            '--date',                   '[parameters] date',                str),
-        ('fetch_all',           '--all',                    '[parameters] all',                 bool),
-
-        ('folder',              '--folder',                 '[parameters] folder',              str),
-        ('extract_dir',         '--extract-dir',            '[parameters] extract-dir',         str),
-        ('max_size',            '--max-size',               '[parameters] max-size',            str),
-        ('flagged_action',      '--flagged',                '[parameters] flagged',             str),
-        ('dir_reg',             '--dir-reg',                '[parameters] dir-reg',             str),
-
-        ('no_subdir',           '--no-subdir',              '[options] no-subdir',              bool),
-        ('thunderbird_mode',    '--thunderbird',            '[options] thunderbird',            bool),
-        ('extract_only',        '--extract-only',           '[options] extract-only',           bool),
-        ('inline_images',       '--inline-images',          '[options] inline-images',          bool),
-        ('dry_run',             '--dry-run',                '[options] dry-run',                bool),
-        ('ask_password',        '--password',               '[options] password',               bool),
-        ('debug',               '--debug',                  '[options] debug',                  bool),
-        ('verbose',             '--verbose',                '[options] verbose',                bool),
-    }
-
     kwargs = {}
 
-    # parse configuration file
+    # parse configuration file, overwritten by the options different from their default
     config = parse_configuration(conf_file)
-    for a in arguments:
-        # ConfigParser section and option name
-        match = re.match('^\[(.*)\] (.*)$', a[2])
-        section = match.group(1)
-        option = match.group(2)
-
-        if a[3] == int:
-            kwargs[a[0]] = config.getint(section, option, fallback=None)
-        elif a[3] == bool:
-            kwargs[a[0]] = config.getboolean(section, option, fallback=None)
-        else:
-            kwargs[a[0]] = config.get(section, option, fallback=None)
-
-    # calculate overwrite
-    overwrite = {}
-    for a in arguments:
-        overwrite[a[0]] = (options.get(a[1], None) != defaults.get(a[1], None))
-
-    # parse options
-    for a in arguments:
-        if kwargs[a[0]] is None or overwrite[a[0]]:
-            if a[3] == int:
-                kwargs[a[0]] = int(options[a[1]])
+    overwritten = {option for option, value in options.items() if value is not None and value != defaults.get(option, None)}
+    for name, option, section, key, value_type in ARGUMENTS:
+        value = options.get(option, None)
+        if config is not None and option not in overwritten:
+            if value_type == int:
+                config_value = config.getint(section, key, fallback=None)
+            elif value_type == bool:
+                config_value = config.getboolean(section, key, fallback=None)
             else:
-                kwargs[a[0]] = options[a[1]]
+                config_value = config.get(section, key, fallback=None)
+
+            if config_value is not None:
+                kwargs[name] = config_value
+                continue
+
+        kwargs[name] = int(value) if value_type == int else value
 
     # handle --run option
     if run and kwargs.get('dry_run', False):
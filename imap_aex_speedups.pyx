@@ -0,0 +1,61 @@
+# cython: language_level=3
+"""Compiled versions of the imap_aex hot loops, used when the extension is built."""
+
+LIST_START = object()
+LIST_END = object()
+
+
+def tokenize_fetch_data(fetch_data):
+    """Tokenize the data returned by an imaplib FETCH command.
+
+    :param list fetch_data: The FETCH response data, a list of bytes and (bytes, literal) tuples.
+    :return: A generator of tokens: list start and end markers, atoms and strings as bytes, literals, None for NIL.
+    """
+    cdef const unsigned char[:] view
+    cdef Py_ssize_t i, j, n
+    cdef unsigned char c
+
+    for piece in fetch_data:
+        if isinstance(piece, tuple):
+            line, literal = piece
+        else:
+            line, literal = piece, None
+
+        if line is None:
+            continue
+
+        view = line
+        i = 0
+        n = len(line)
+        while i < n:
+            c = view[i]
+            if c == 0x20:  # space
+                i = i + 1
+            elif c == 0x28:  # (
+                yield LIST_START
+                i = i + 1
+            elif c == 0x29:  # )
+                yield LIST_END
+                i = i + 1
+            elif c == 0x22:  # quoted string
+                value = bytearray()
+                i = i + 1
+                while view[i] != 0x22:
+                    if view[i] == 0x5c:  # backslash escape
+                        i = i + 1
+                    value.append(view[i])
+                    i = i + 1
+                yield bytes(value)
+                i = i + 1
+            elif (c == 0x7b or c == 0x7e) and literal is not None:  # {size} or ~{size} binary literal marker, ends the line
+                yield literal
+                i = n
+            else:  # atom, possibly with a [section] spec
+                j = i
+                while j < n and view[j] != 0x20 and view[j] != 0x28 and view[j] != 0x29:
+                    if view[j] == 0x5b:  # [
+                        j = line.index(b']', j)
+                    j = j + 1
+                atom = line[i:j]
+                yield None if atom.upper() == b'NIL' else atom
+                i = j
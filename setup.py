@@ -1,5 +1,11 @@
 from setuptools import setup, find_packages
 
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize('imap_aex_speedups.pyx', language_level=3)
+except ImportError:
+    ext_modules = []  # optional, imap_aex falls back to pure Python
+
 requires = [
     'docopt',
     'keyring'
@@ -13,6 +19,7 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=requires,
+    ext_modules=ext_modules,
     entry_points={
         'console_scripts': [
             'imap_aex           = imap_aex:cli'
@@ -0,0 +1,697 @@
+"""Tests of the IMAP attachment extractor.
+
+Run with: python -m unittest discover tests
+"""
+import imaplib
+import importlib.util
+import io
+import os
+import queue
+import sys
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timezone
+from email import policy
+from email.message import Message
+from email.parser import BytesParser
+from unittest import mock
+from base64 import encodebytes
+from binascii import a2b_qp, b2a_qp
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import imap_aex
+
+try:
+    import imap_aex_speedups
+except ImportError:
+    imap_aex_speedups = None
+
+
+def load_pure_python_module():
+    """Load a copy of imap_aex without the compiled extension.
+
+    :return: The module, using the pure Python tokenizer.
+    """
+    saved = sys.modules.get('imap_aex_speedups')
+    sys.modules['imap_aex_speedups'] = None  # makes the import fail
+    try:
+        spec = importlib.util.spec_from_file_location('imap_aex_pure', imap_aex.__file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        if saved is None:
+            del sys.modules['imap_aex_speedups']
+        else:
+            sys.modules['imap_aex_speedups'] = saved
+
+    return module
+
+
+imap_aex_pure = load_pure_python_module()
+
+# UID FETCH response data, as returned by imaplib
+FETCH_DATA = [
+    (b'1 (UID 11 FLAGS (\\Seen $Label1) BODY[HEADER.FIELDS (DATE SUBJECT)] {32}',
+     b'Subject: test\r\nDate: whenever\r\n\r\n'),
+    b' BODYSTRUCTURE (("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 12 1 NIL NIL NIL NIL)'
+    b'("application" "pdf" ("name" "a \\"quoted\\" name.pdf") NIL NIL "base64" 4096 NIL ("attachment" NIL) NIL NIL)'
+    b' "mixed" ("boundary" "xyz") NIL NIL NIL))',
+    (b'2 (UID 12 BINARY.PEEK[2] ~{3}', b'\x00\x01\x02'),
+    b')',
+    b'3 (FLAGS (\\Deleted))',  # unsolicited, without UID
+    (b'4 (UID 14 BODY[] {5}', b'hello'),
+    b')',
+    b'4 (UID 14 FLAGS (\\Flagged))',
+]
+
+BODYSTRUCTURE_MIXED = (
+    b'1 (UID 1 BODYSTRUCTURE ('
+    b'(("text" "plain" ("charset" "utf-8") NIL NIL "quoted-printable" 120 4 NIL NIL NIL NIL)'
+    b'("text" "html" ("charset" "utf-8") NIL NIL "quoted-printable" 300 8 NIL NIL NIL NIL) "alternative" ("boundary" "b2") NIL NIL NIL)'
+    b'("application" "pdf" ("name" "=?utf-8?q?r=C3=A9sum=C3=A9.pdf?=") NIL NIL "base64" 200000 NIL'
+    b' ("attachment" ("filename*" "utf-8\'\'r%C3%A9sum%C3%A9%20%C3%A9t%C3%A9.pdf")) NIL NIL)'
+    b'("image" "png" ("name" "logo.png") "<logo>" NIL "base64" 5000 NIL ("inline" NIL) NIL NIL)'
+    b'("message" "rfc822" NIL NIL NIL "7bit" 900 ("date" "subject" NIL NIL NIL NIL NIL NIL NIL "id")'
+    b' ("text" "plain" NIL NIL NIL "7bit" 10 1 NIL NIL NIL NIL) 20 NIL ("attachment" ("filename" "fwd.eml")) NIL NIL)'
+    b' "mixed" ("boundary" "b1") NIL NIL NIL))'
+)
+
+
+def readable_tokens(tokens, list_start, list_end):
+    """Replace the list markers of a tokens list by '(' and ')'."""
+    return ['(' if t is list_start else ')' if t is list_end else t for t in tokens]
+
+
+class TokenizeFetchDataTest(unittest.TestCase):
+
+    def test_tokens(self):
+        tokens = readable_tokens(imap_aex_pure.tokenize_fetch_data([
+            (b'1 (UID 11 BODY[HEADER.FIELDS (DATE SUBJECT)] {3}', b'abc'),
+            b' X "a \\"b\\" \\\\c" NIL nil (A (B)))',
+            (b'2 (BINARY[1] ~{2}', b'\x00\xff'),
+            b')',
+        ]), imap_aex_pure._LIST_START, imap_aex_pure._LIST_END)
+
+        self.assertEqual(tokens, [
+            b'1', '(', b'UID', b'11', b'BODY[HEADER.FIELDS (DATE SUBJECT)]', b'abc',
+            b'X', b'a "b" \\c', None, None, '(', b'A', '(', b'B', ')', ')', ')',
+            b'2', '(', b'BINARY[1]', b'\x00\xff', ')',
+        ])
+
+    @unittest.skipIf(imap_aex_speedups is None, "compiled extension not built")
+    def test_compiled_tokenizer_matches(self):
+        for fetch_data in (FETCH_DATA, [BODYSTRUCTURE_MIXED]):
+            self.assertEqual(
+                readable_tokens(imap_aex_speedups.tokenize_fetch_data(fetch_data),
+                                imap_aex_speedups.LIST_START, imap_aex_speedups.LIST_END),
+                readable_tokens(imap_aex_pure.tokenize_fetch_data(fetch_data),
+                                imap_aex_pure._LIST_START, imap_aex_pure._LIST_END))
+
+
+class ParseFetchDataTest(unittest.TestCase):
+
+    def test_responses(self):
+        for module in (imap_aex, imap_aex_pure):
+            responses = module.parse_fetch_data(FETCH_DATA)
+
+            self.assertEqual([uid for uid, items in responses], [b'11', b'12', b'14', b'14'])
+            self.assertEqual(responses[0][1][b'FLAGS'], [b'\\Seen', b'$Label1'])
+            self.assertEqual(responses[0][1][b'BODY[HEADER.FIELDS (DATE SUBJECT)]'], b'Subject: test\r\nDate: whenever\r\n\r\n')
+            self.assertEqual(responses[1][1][b'BINARY.PEEK[2]'], b'\x00\x01\x02')
+            self.assertEqual(responses[2][1][b'BODY[]'], b'hello')
+            self.assertEqual(responses[3][1][b'FLAGS'], [b'\\Flagged'])
+
+    def test_unsolicited_responses_dropped(self):
+        self.assertEqual(imap_aex.parse_fetch_data([b'11 (FLAGS (\\Seen \\Deleted))']), [])
+
+    def test_prefilter(self):
+        filtered = imap_aex.filter_fetch_data(FETCH_DATA, imap_aex.ATTACHMENT_REGEX)
+        self.assertEqual([uid for uid, items in imap_aex.parse_fetch_data(filtered)], [b'11'])
+
+
+class ParseBodystructureTest(unittest.TestCase):
+
+    def test_multipart(self):
+        structure = imap_aex.parse_fetch_data([BODYSTRUCTURE_MIXED])[0][1][b'BODYSTRUCTURE']
+        parts = imap_aex.parse_bodystructure(structure)
+
+        self.assertEqual([(p.section, p.content_type, p.encoding, p.size, p.disposition) for p in parts], [
+            ('1.1', 'text/plain', 'quoted-printable', 120, None),
+            ('1.2', 'text/html', 'quoted-printable', 300, None),
+            ('2', 'application/pdf', 'base64', 200000, 'attachment'),
+            ('3', 'image/png', 'base64', 5000, 'inline'),
+            ('4', 'message/rfc822', '7bit', 900, 'attachment'),
+        ])
+        self.assertEqual(parts[2].filename, 'résumé été.pdf')
+        self.assertEqual(parts[3].filename, 'logo.png')
+        self.assertEqual(parts[4].filename, 'fwd.eml')
+
+    def test_single_part(self):
+        structure = imap_aex.parse_fetch_data([
+            b'1 (UID 1 BODYSTRUCTURE ("application" "zip" ("name" "=?utf-8?q?=C3=A9.zip?=") NIL NIL "base64" 1000 NIL NIL NIL NIL))'
+        ])[0][1][b'BODYSTRUCTURE']
+
+        self.assertEqual(imap_aex.parse_bodystructure(structure), [
+            imap_aex.BodyPart('1', 'application/zip', 'base64', 1000, None, 'é.zip'),
+        ])
+
+    def test_raw_disposition(self):
+        structure = imap_aex.parse_fetch_data([
+            b'1 (UID 1 BODYSTRUCTURE ("application" "pdf" NIL NIL NIL "base64" 1000 NIL'
+            b' "attachment; filename=\\"raw.pdf\\"" NIL NIL))'
+        ])[0][1][b'BODYSTRUCTURE']
+
+        part = imap_aex.parse_bodystructure(structure)[0]
+        self.assertEqual((part.disposition, part.filename), ('attachment', 'raw.pdf'))
+
+
+class DecodeToFileTest(unittest.TestCase):
+
+    data = bytes(range(256)) * 1000 + b'end'
+
+    def decode(self, content, encoding):
+        file = io.BytesIO()
+        size = imap_aex.decode_to_file(content, encoding, file)
+        self.assertEqual(size, len(file.getvalue()))
+        return file.getvalue()
+
+    def test_base64(self):
+        encoded = encodebytes(self.data)
+        self.assertEqual(self.decode(encoded, "base64"), self.data)
+        self.assertEqual(self.decode(encoded.decode("ascii").replace("\n", "\r\n"), "base64"), self.data)
+
+    def test_base64_truncated(self):
+        with self.assertRaises(imap_aex.BinasciiError):
+            self.decode(encodebytes(self.data)[:-3], "base64")
+
+    def test_quoted_printable(self):
+        encoded = b2a_qp(self.data)
+        self.assertEqual(self.decode(encoded, "quoted-printable"), self.data)
+        encoded = encoded.replace(b"\n", b"\r\n")  # hard line breaks are decoded as is
+        self.assertEqual(self.decode(encoded, "quoted-printable"), a2b_qp(encoded))
+
+    def test_no_encoding(self):
+        self.assertEqual(self.decode(self.data, None), self.data)
+
+
+class SizeConversionTest(unittest.TestCase):
+
+    def test_size_to_bytes(self):
+        self.assertEqual(imap_aex.human_readable_size_to_bytes('100'), 100)
+        self.assertEqual(imap_aex.human_readable_size_to_bytes('100K'), 102400)
+        self.assertEqual(imap_aex.human_readable_size_to_bytes('1.5m'), 1572864)
+        self.assertEqual(imap_aex.human_readable_size_to_bytes('10MB'), 10485760)
+        self.assertEqual(imap_aex.human_readable_size_to_bytes('2Y'), 2 * 1024 ** 8)
+        self.assertIsNone(imap_aex.human_readable_size_to_bytes(None))
+
+    def test_wrong_size(self):
+        for size_label in ('', 'M', '-1K', '10 MB', '10MO'):
+            with self.subTest(size_label=size_label):
+                self.assertRaises(SyntaxWarning, imap_aex.human_readable_size_to_bytes, size_label)
+
+    def test_human_readable_size(self):
+        self.assertEqual(imap_aex.human_readable_size(512), "512.0B")
+        self.assertEqual(imap_aex.human_readable_size(1572864), "1.5MB")
+        self.assertEqual(imap_aex.human_readable_size(1024 ** 8), "1.0YiB")
+
+
+class ImapUtf7Test(unittest.TestCase):
+
+    names = {
+        'INBOX': 'INBOX',
+        'Envoyés': 'Envoy&AOk-s',
+        'a&b': 'a&-b',
+        '~peter/mail/台北/日本語': '~peter/mail/&U,BTFw-/&ZeVnLIqe-',
+        '😀 &é': '&2D3eAA- &-&AOk-',
+        '\x7f': '&AH8-',
+    }
+
+    def test_encode(self):
+        for name, encoded in self.names.items():
+            self.assertEqual(imap_aex.imaputf7encode(name), encoded)
+
+    def test_decode(self):
+        for name, encoded in self.names.items():
+            self.assertEqual(imap_aex.imaputf7decode(encoded), name)
+
+
+class FakeImap:
+    """Scripted IMAP connection, answering the commands without server."""
+
+    def __init__(self, answers=None):
+        """
+        :param dict answers: The UID FETCH answers by message set, or by (message set, data items): an exception to
+            raise, or the (status, data) tuple. The data is the FETCH responses if OK, the tagged response text if not.
+            (default: OK without data)
+        """
+        self.answers = answers or {}
+        self.commands = []
+        self.pending = {}
+        self.untagged_responses = {}
+        self.literal = None
+        self.appended = []  # APPEND literals
+        self.state = 'AUTH'
+
+    def _command(self, name, *args):
+        self.commands.append((name,) + args)
+        tag = len(self.commands)
+        self.pending[tag] = args
+        return tag
+
+    def _command_complete(self, name, tag):
+        args = self.pending.pop(tag)
+        answer = self.answers.get(tuple(args[1:3]), self.answers.get(args[1], ('OK', [])))
+        if isinstance(answer, Exception):
+            raise answer
+
+        status, data = answer
+        if status != 'OK':
+            return status, data
+
+        if data:
+            self.untagged_responses.setdefault('FETCH', []).extend(data)
+        return status, [b'completed']
+
+    def _untagged_response(self, typ, dat, name):
+        if typ == 'NO':
+            return typ, dat
+        return typ, self.untagged_responses.pop(name, [None])
+
+    def _simple_command(self, name, *args):
+        self.commands.append((name,) + args)
+        if name == 'APPEND':
+            self.appended.append(bytes(self.literal))
+        return 'OK', [b'completed']
+
+    def select(self, mailbox, readonly=False):
+        return 'OK', [b'1']
+
+    def logout(self):
+        self.state = 'LOGOUT'
+        return 'BYE', [b'logout']
+
+
+def fetch_response(*uids):
+    """Get the FETCH response data of messages."""
+    return [b'%d (UID %d FLAGS ())' % (uid, uid) for uid in uids]
+
+
+def extractor(**kwargs):
+    """Get an extractor on a fake IMAP connection."""
+    kwargs.setdefault('extract_dir', os.devnull)
+    instance = imap_aex.ImapAttachmentExtractor('localhost', 'user', no_subdir=True, **kwargs)
+    instance.imap = FakeImap()
+    return instance
+
+
+class UniqueFilenameTest(unittest.TestCase):
+
+    mail_date = datetime(2020, 5, 1, 10)
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.extract_dir = temp_dir.name
+
+    def touch(self, *filenames):
+        for filename in filenames:
+            open(os.path.join(self.extract_dir, filename), 'w').close()
+
+    def test_new_file(self):
+        instance = extractor(extract_dir=self.extract_dir)
+        self.assertEqual(instance.unique_filename(self.mail_date, "doc.pdf"), "2020-05-01 - doc.pdf")
+        self.assertEqual(instance.unique_filename(None, "doc.pdf"), "0000-00-00 - doc.pdf")
+
+    def test_existing_files(self):
+        self.touch("2020-05-01 - doc.pdf", "2020-05-01 (03) - doc.pdf", "2020-05-01 - other.pdf", "2020-05-02 - doc.pdf")
+        instance = extractor(extract_dir=self.extract_dir)
+        self.assertEqual(instance.unique_filename(self.mail_date, "doc.pdf"), "2020-05-01 (04) - doc.pdf")
+        self.assertEqual(instance.unique_filename(self.mail_date, "other.pdf"), "2020-05-01 (01) - other.pdf")
+
+    def test_keep_filename(self):
+        instance = extractor(extract_dir=self.extract_dir)
+        self.assertEqual(instance.unique_filename(self.mail_date, "doc.pdf"), "2020-05-01 - doc.pdf")
+        # not kept, the filename is reused without a gap in the indexes
+        self.assertEqual(instance.unique_filename(self.mail_date, "doc.pdf"), "2020-05-01 - doc.pdf")
+        instance.keep_filename(self.mail_date, "doc.pdf")
+        self.assertEqual(instance.unique_filename(self.mail_date, "doc.pdf"), "2020-05-01 (01) - doc.pdf")
+        instance.keep_filename(self.mail_date, "doc.pdf")
+        self.assertEqual(instance.unique_filename(self.mail_date, "doc.pdf"), "2020-05-01 (02) - doc.pdf")
+
+
+MESSAGE_MIXED = b"""\
+Subject: Report
+Date: Fri, 01 May 2020 10:00:00 +0000
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="mixed"
+
+--mixed
+Content-Type: multipart/alternative; boundary="alternative"
+
+--alternative
+Content-Type: text/plain
+
+Plain text body.
+--alternative
+Content-Type: text/html
+
+<p>HTML body.</p>
+--alternative--
+--mixed
+Content-Type: application/pdf; name="report.pdf"
+Content-Disposition: attachment; filename="report.pdf"
+Content-Transfer-Encoding: base64
+
+%s
+--mixed--
+""".replace(b"\n", b"\r\n") % encodebytes(b"PDF content" * 10).strip()
+
+
+class RebuildMessageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mail = BytesParser(policy=policy.compat32).parsebytes(MESSAGE_MIXED)
+        self.attachment = self.mail.get_payload(1)
+
+    def test_remove_part(self):
+        new_mail = imap_aex.rebuild_message(self.mail, {id(self.attachment): None})
+
+        self.assertEqual(len(new_mail.get_payload()), 1)
+        alternative = new_mail.get_payload(0)
+        self.assertEqual([part.get_content_type() for part in alternative.get_payload()], ["text/plain", "text/html"])
+        self.assertEqual(new_mail["Subject"], "Report")
+        self.assertEqual(len(self.mail.get_payload()), 2)  # original message left intact
+
+    def test_replace_part(self):
+        stub = Message()
+        stub.set_payload("detached")
+        new_mail = imap_aex.rebuild_message(self.mail, {id(self.attachment): stub})
+
+        self.assertIs(new_mail.get_payload(1), stub)
+        self.assertIn(b'boundary="mixed"', new_mail.as_bytes())
+
+    def test_remove_message(self):
+        self.assertIsNone(imap_aex.rebuild_message(self.mail, {id(self.mail): None}))
+
+
+class DetachAttachmentsTest(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.extract_dir = temp_dir.name
+
+    def detach(self, flags=('\\Seen',), **kwargs):
+        instance = extractor(extract_dir=self.extract_dir, max_size=10, **kwargs)
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            instance.detach_attachments(b'7', flags, {b'BODY[]': MESSAGE_MIXED}, "Report", datetime(2020, 5, 1, 10), 'INBOX')
+        return instance
+
+    def test_thunderbird_mode(self):
+        instance = self.detach(thunderbird_mode=True)
+
+        with open(os.path.join(self.extract_dir, "2020-05-01 - report.pdf"), 'rb') as file:
+            self.assertEqual(file.read(), b"PDF content" * 10)
+        self.assertEqual(instance.imap.commands[0][:3], ('APPEND', 'INBOX', '(\\Seen)'))
+        literal = instance.imap.appended[0]
+        self.assertIn(b"X-Mozilla-Altered: AttachmentDetached", literal)
+        self.assertIn(b"X-Mozilla-External-Attachment-URL:", literal)
+        self.assertIn(b"/2020-05-01 - report.pdf\r\n", literal)
+        self.assertIn(b"Plain text body.\r\n", literal)
+        self.assertIn(b"<p>HTML body.</p>\r\n", literal)
+        self.assertNotIn(encodebytes(b"PDF content" * 10).strip(), literal)
+        self.assertEqual(instance.deleted_uids, [b'7'])
+        self.assertEqual((instance.extracted_nb, instance.extracted_from_nb), (1, 1))
+
+    def test_remove_attachment(self):
+        instance = self.detach()
+
+        literal = instance.imap.appended[0]
+        self.assertNotIn(b"report.pdf", literal)
+        self.assertIn(b"Content-Type: multipart/alternative", literal)
+        self.assertEqual(instance.deleted_uids, [b'7'])
+
+    def test_flagged_skip(self):
+        instance = self.detach(flags=('\\Flagged',))
+
+        self.assertEqual(os.listdir(self.extract_dir), [])
+        self.assertEqual(instance.imap.commands, [])
+        self.assertEqual(instance.deleted_uids, [])
+
+    def test_dry_run(self):
+        instance = self.detach(dry_run=True)
+
+        self.assertEqual(os.listdir(self.extract_dir), [])
+        self.assertEqual(instance.imap.commands, [])
+        self.assertEqual(instance.deleted_uids, [])
+
+
+class MainTest(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.conf_file = os.path.join(temp_dir.name, 'config.ini')
+        with open(self.conf_file, 'w') as file:
+            file.write("[imap]\nport = 1234\n[parameters]\nfolder = Archives\nfetch-batch = 7\n[options]\nverbose = true\n")
+
+    def main(self, *argv):
+        """Run main on a command line, returning the extractor arguments and the extract method mock."""
+        options = imap_aex.docopt(imap_aex.__doc__, argv=argv)
+        defaults = dict(map(lambda x: (x.long, x.value), imap_aex.parse_defaults(imap_aex.__doc__)))
+        imap_aex.parse_configuration.cache_clear()
+        self.addCleanup(imap_aex.parse_configuration.cache_clear)
+        with mock.patch.object(imap_aex, 'ImapAttachmentExtractor') as extractor_class:
+            imap_aex.main(options, defaults)
+        return extractor_class.call_args.kwargs, extractor_class.return_value.__enter__.return_value
+
+    def test_missing_configuration(self):
+        kwargs, instance = self.main('host', 'user', '--conf=%s' % os.path.join(os.path.dirname(self.conf_file), 'none.ini'))
+
+        self.assertEqual((kwargs['host'], kwargs['login'], kwargs['port']), ('host', 'user', 993))
+        self.assertEqual((kwargs['folder'], kwargs['fetch_batch'], kwargs['verbose']), ('INBOX', 100, False))
+        self.assertEqual(set(kwargs), {argument[0] for argument in imap_aex.ARGUMENTS} - {'date_def', 'fetch_all'})
+        instance.extract.assert_called_once_with(date_def=None, fetch_all=False)
+
+    def test_configuration(self):
+        kwargs, instance = self.main('host', 'user', '--conf=%s' % self.conf_file)
+
+        self.assertEqual((kwargs['port'], kwargs['folder'], kwargs['fetch_batch'], kwargs['verbose']), (1234, 'Archives', 7, True))
+        self.assertEqual(kwargs['host'], 'host')  # missing from the configuration
+
+    def test_options_override_configuration(self):
+        kwargs, instance = self.main('host', 'user', '--conf=%s' % self.conf_file, '--port=99', '--folder=Sent', '--list')
+
+        self.assertEqual((kwargs['port'], kwargs['folder'], kwargs['fetch_batch']), (99, 'Sent', 7))
+        instance.list.assert_called_once_with()
+        instance.extract.assert_not_called()
+
+    def test_run(self):
+        kwargs, instance = self.main('host', 'user', '--conf=%s' % self.conf_file, '--dry-run', '--run')
+
+        self.assertFalse(kwargs['dry_run'])
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(imap_aex.ImapAttachmentExtractor.close_connection_pool)
+
+    def pooled_extractor(self, login='user'):
+        instance = imap_aex.ImapAttachmentExtractor('localhost', login, extract_dir=os.devnull, no_subdir=True, pool_connection=True)
+        instance.password = 'password'
+        return instance
+
+    def test_reuse(self):
+        imap = FakeImap()
+        with mock.patch.object(imap_aex.ImapAttachmentExtractor, 'open_connection', return_value=imap) as open_connection:
+            with self.pooled_extractor() as instance:
+                self.assertIs(instance.imap, imap)
+            with self.pooled_extractor() as instance:
+                self.assertIs(instance.imap, imap)
+            with self.pooled_extractor('other') as instance:
+                pass
+
+        self.assertEqual(open_connection.call_count, 2)  # one per login
+        self.assertEqual(imap.state, 'AUTH')
+
+        imap_aex.ImapAttachmentExtractor.close_connection_pool()
+        self.assertEqual(imap.state, 'LOGOUT')
+        self.assertEqual(imap_aex.ImapAttachmentExtractor.connection_pool, {})
+
+    def test_not_pooled(self):
+        imap = FakeImap()
+        instance = extractor()
+        with mock.patch.object(imap_aex.ImapAttachmentExtractor, 'open_connection', return_value=imap):
+            instance.password = 'password'
+            with instance:
+                pass
+
+        self.assertEqual(imap.state, 'LOGOUT')
+        self.assertEqual(imap_aex.ImapAttachmentExtractor.connection_pool, {})
+
+
+class FetchPipelineTest(unittest.TestCase):
+
+    requests = [(b'%d' % i, '(FLAGS)') for i in range(1, 5)]
+
+    def fetch(self, answers):
+        instance = extractor()
+        instance.imap.answers = answers
+        results = []
+        try:
+            for request, responses in instance.fetch_pipeline(self.requests):
+                results.append((request[0], [uid for uid, items in responses]))
+        finally:
+            self.results = results
+        return results
+
+    def test_responses(self):
+        answers = {b'%d' % i: ('OK', fetch_response(i)) for i in range(1, 5)}
+        self.assertEqual(self.fetch(answers), [(b'1', [b'1']), (b'2', [b'2']), (b'3', [b'3']), (b'4', [b'4'])])
+
+    def test_failed_request_skipped(self):
+        answers = {b'1': ('OK', fetch_response(1)), b'2': ('NO', [b'failed']), b'3': imaplib.IMAP4.error("bad"),
+                   b'4': ('OK', fetch_response(4))}
+        self.assertEqual(self.fetch(answers), [(b'1', [b'1']), (b'4', [b'4'])])
+
+    def test_connection_lost(self):
+        answers = {b'1': ('OK', fetch_response(1)), b'2': imaplib.IMAP4.abort("socket error"),
+                   b'3': ('OK', fetch_response(3))}
+        with self.assertRaises(imaplib.IMAP4.abort):
+            self.fetch(answers)
+        self.assertEqual(self.results, [(b'1', [b'1'])])
+
+
+class BinaryRefusedTest(unittest.TestCase):
+
+    requests = [(b'1', '(BINARY.PEEK[2])'), (b'2', '(BINARY.PEEK[2])'), (b'3', '(BINARY.PEEK[2])')]
+    answers = {
+        (b'1', '(BINARY.PEEK[2])'): ('NO', [b'[UNKNOWN-CTE] Can not decode part 2']),
+        (b'2', '(BINARY.PEEK[2])'): ('OK', [(b'2 (UID 2 BINARY[2] {3}', b'abc'), b')']),
+        (b'1', '(BODY.PEEK[2])'): ('OK', [(b'1 (UID 1 BODY[2] {4}', b'YWJj'), b')']),
+        (b'2', '(BODY.PEEK[2])'): ('OK', [(b'2 (UID 2 BODY[2] {4}', b'YWJj'), b')']),
+        (b'3', '(BODY.PEEK[2])'): imaplib.IMAP4.abort("socket error"),
+    }
+
+    def test_fetch_undecoded(self):
+        instance = extractor()
+        instance.imap.answers = self.answers
+        results = [(request[0], responses[0][1]) for request, responses in instance.fetch_pipeline(self.requests[:2])]
+
+        # the request in flight when the server refused BINARY is still sent with BINARY.PEEK
+        self.assertEqual(results, [(b'2', {b'UID': b'2', b'BINARY[2]': b'abc'}), (b'1', {b'UID': b'1', b'BODY[2]': b'YWJj'})])
+        self.assertTrue(instance.binary_refused)
+
+    def test_handoff(self):
+        instance = extractor()
+        instance.open_connection = lambda: FakeImap(self.answers)
+        results = queue.Queue()
+        instance.fetch_worker(self.requests, 'INBOX', results, threading.Event())
+        results = [results.get_nowait() for i in range(results.qsize())]
+
+        self.assertEqual([request[0] for request, responses in results[:-2]], [b'2', b'1'])
+        self.assertEqual(results[-2], (None, self.requests[2:]))
+
+    def test_extract_parts(self):
+        instance = extractor(max_size=0, dry_run=True)
+        part = imap_aex.BodyPart('2', 'application/pdf', 'base64', 4, 'attachment', 'a.pdf')
+        with mock.patch.object(instance, 'save_attachment', return_value=(None, None)) as save_attachment:
+            instance.extract_parts(b'1', (), [part], {b'UID': b'1', b'BODY[2]': b'YWJj'}, 'subject', None)
+            instance.extract_parts(b'2', (), [part], {b'UID': b'2', b'BINARY[2]': b'abc'}, 'subject', None)
+
+        self.assertEqual([c[0][:2] for c in save_attachment.call_args_list], [(b'YWJj', 'base64'), (b'abc', None)])
+
+
+class AppendMessageTest(unittest.TestCase):
+
+    def test_literal(self):
+        message = Message()
+        message["Subject"] = "Envoyé"
+        message.set_payload("line 1\nline 2\n")
+        instance = extractor()
+
+        status, append_data = instance.append_message('Envoyés', ('\\Seen', '$Label1'), datetime(2020, 5, 1, 10, tzinfo=timezone.utc), message)
+
+        self.assertEqual(status, 'OK')
+        name, folder, flags, date = instance.imap.commands[-1]
+        self.assertEqual((name, folder, flags), ('APPEND', 'Envoy&AOk-s', '(\\Seen $Label1)'))
+        self.assertTrue(date.startswith('"01-May-2020 '))
+        self.assertEqual(instance.imap.appended, ['Subject: Envoyé\r\n\r\nline 1\r\nline 2\r\n'.encode()])
+
+    def test_no_flags_nor_date(self):
+        message = Message()
+        message.set_payload("body")
+        instance = extractor()
+        instance.append_message('INBOX', (), None, message)
+
+        self.assertEqual(instance.imap.commands[-1], ('APPEND', 'INBOX', None, None))
+
+
+class DeleteMessagesTest(unittest.TestCase):
+
+    def test_batches(self):
+        instance = extractor()
+        instance.deleted_uids = [b'1', b'2', b'3', b'4', b'5']
+        with mock.patch.object(imap_aex, 'STORE_BATCH_SIZE', 2):
+            instance.delete_messages()
+
+        self.assertEqual([command[2] for command in instance.imap.commands], [b'1,2', b'3,4', b'5'])
+        self.assertEqual(instance.imap.commands[0], ('UID', 'STORE', b'1,2', '+FLAGS.SILENT', '\\Deleted'))
+        self.assertEqual(instance.deleted_uids, [])
+
+    def test_failed_batch(self):
+        instance = extractor()
+        instance.deleted_uids = [b'1', b'2', b'3']
+        answers = [imaplib.IMAP4.error("STORE failed"), ('OK', [b'completed'])]
+        with mock.patch.object(imap_aex, 'STORE_BATCH_SIZE', 2), \
+                mock.patch.object(instance.imap, '_simple_command', side_effect=answers) as store, \
+                mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            instance.delete_messages()
+
+        self.assertEqual(store.call_count, 2)  # the next batches are still deleted
+        self.assertIn("Could not delete original messages 1,2", stdout.getvalue())
+
+
+class FetchWorkerTest(unittest.TestCase):
+
+    requests = [(b'%d' % i, '(FLAGS)') for i in range(1, 7)]
+
+    def work(self, open_connection):
+        instance = extractor()
+        instance.open_connection = open_connection
+        results = queue.Queue()
+        instance.fetch_worker(self.requests, 'INBOX', results, threading.Event())
+        return [results.get_nowait() for i in range(results.qsize())]
+
+    def test_connection_lost(self):
+        answers = {b'1': ('NO', [b'failed']), b'2': ('OK', fetch_response(2)), b'3': imaplib.IMAP4.abort("socket error")}
+        results = self.work(lambda: FakeImap(answers))
+
+        self.assertEqual([request[0] for request, responses in results[:-2]], [b'2'])
+        self.assertEqual(results[-2], (None, self.requests[2:]))  # neither the failed nor the fetched requests
+        self.assertIsNone(results[-1])
+
+    def test_connection_refused(self):
+        def open_connection():
+            raise OSError("connection refused")
+
+        self.assertEqual(self.work(open_connection), [(None, self.requests), None])
+
+    def test_parallel_fallback(self):
+        instance = extractor()
+        instance.imap.answers = {b'%d' % i: ('OK', fetch_response(i)) for i in range(1, 7)}
+        connections = iter([FakeImap(instance.imap.answers), FakeImap({b'2': imaplib.IMAP4.abort("socket error")}),
+                            FakeImap(instance.imap.answers)])
+        instance.open_connection = lambda: next(connections)
+
+        with mock.patch.object(imap_aex, 'FETCH_CONNECTION_MESSAGES', 1):
+            fetched = [request[0] for request, responses in instance.fetch_parallel(self.requests, 'INBOX')]
+
+        self.assertEqual(sorted(fetched), [request[0] for request in self.requests])  # each request fetched once
+
+
+if __name__ == '__main__':
+    unittest.main()